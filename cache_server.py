@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013-2014 Synchrotron Light Source Australia Pty Ltd.
+# Released under the Modified BSD license
+# See LICENSE
+
+"""
+A local cache service that lets several Sakura processes on one host share decoded
+spectrum cubes. The server owns a directory in shared memory (/dev/shm where it
+exists) holding cubes in the .npy export format of DetectorData.export(), sparse
+cubes as the columns of their store, keyed by the DetectorData.fingerprint() of the
+netCDF files they were decoded from.
+DetectorData instances created with cache_socket ask the server for their scan's
+cube and map it read-only if another instance has already decoded it. Otherwise the
+first one to ask decodes the cube, exports it into a private directory at a path the
+server gives it and tells the server it is ready; others asking in the meantime
+decode their own. The server then moves the directory into place, or copies it if
+it belongs to another user, so that published cubes can only be changed by the
+server.
+
+Run the server with
+    python cache_server.py [socket_path [max_megabytes]]
+
+Requests and replies are single lines of JSON over a Unix socket, one request per
+connection:
+    {"op": "lookup", "fingerprint": f} - {"status": "ready", "path": p} if the cube is
+        cached, else {"status": "missing"}
+    {"op": "get", "fingerprint": f} - as lookup, but if the cube isn't cached and
+        nobody is building it, {"status": "build", "path": p, "token": t}, asking
+        the caller to create the directory p, writable only by itself, export the
+        cube to it then send put. If another client is building it,
+        {"status": "building"}.
+    {"op": "put", "fingerprint": f, "token": t} - publish the cube exported by the
+        builder, replying like lookup with the path of the published cube
+    {"op": "abort", "fingerprint": f, "token": t} - give up building the cube
+    {"op": "stats"} - {"status": "ok", "cubes": n, "bytes": b}
+
+"""
+
+import os
+import sys
+import stat
+import errno
+import json
+import time
+import uuid
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import SocketServer
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'sakura-cache.sock')
+SHM_DIR = '/dev/shm'
+# a build not put or aborted within this many seconds is assumed to have died
+BUILD_TIMEOUT = 600
+
+
+def request(socket_path, timeout=10.0, **message):
+    """Send a request to the cache server and return its reply.
+
+    Keyword arguments:
+    socket_path - path of the server's Unix socket
+    timeout - seconds to wait for the server
+    message - request items, e.g. op='get', fingerprint=...
+
+    Raises:
+    socket.error if the server can't be reached, ValueError for a malformed reply
+
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise socket.error('Unix sockets are not supported on this platform')
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(message) + '\n')
+        f = s.makefile('rb')
+        try:
+            return json.loads(f.readline())
+        finally:
+            f.close()
+    finally:
+        s.close()
+
+
+class CubeStore(object):
+    """The cubes held by the server, and those being built by clients."""
+    def __init__(self, root, max_bytes=None):
+        """
+        Keyword arguments:
+        root - directory holding the cubes, created if necessary
+        max_bytes - max no. of bytes of cubes held. Least recently used cubes are
+                    removed to stay within it; processes that have them mapped keep
+                    their mappings. None means unlimited.
+
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # {fingerprint: {'path', 'nbytes', 'last_used'}} of published cubes and
+        # {fingerprint: {'path', 'token', 'started'}} of cubes being built
+        self.cubes = {}
+        self.builds = {}
+        try:
+            os.mkdir(root)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        st = os.lstat(root)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            raise OSError(errno.EPERM, 'Cache directory not owned by this user', root)
+        # like /tmp: every user's clients may create build directories in it, but
+        # only remove or rename their own
+        os.chmod(root, 0o1777)
+
+    def _path(self, fingerprint, token):
+        return os.path.join(self.root, '{}.{}'.format(
+            hashlib.sha1(fingerprint).hexdigest(), token))
+
+    def handle(self, message):
+        """Return the reply to a request; see the module docstring."""
+        op = message.get('op')
+        with self.lock:
+            if op == 'stats':
+                return {'status': 'ok', 'cubes': len(self.cubes),
+                        'bytes': sum(cube['nbytes'] for cube in self.cubes.itervalues())}
+            fingerprint = message.get('fingerprint')
+            if not isinstance(fingerprint, basestring):
+                return {'status': 'error', 'message': 'missing fingerprint'}
+            fingerprint = fingerprint.encode('utf-8')
+            if op in ('lookup', 'get'):
+                return self._get(fingerprint, build=op == 'get')
+            if op in ('put', 'abort'):
+                build = self.builds.get(fingerprint)
+                if build is None or build['token'] != message.get('token'):
+                    return {'status': 'error', 'message': 'unknown build'}
+                del self.builds[fingerprint]
+                if op == 'abort':
+                    shutil.rmtree(build['path'], ignore_errors=True)
+                    return {'status': 'missing'}
+                return self._publish(fingerprint, build)
+        return {'status': 'error', 'message': 'unknown op {!r}'.format(op)}
+
+    def _get(self, fingerprint, build):
+        cube = self.cubes.get(fingerprint)
+        if cube is not None:
+            cube['last_used'] = time.time()
+            return {'status': 'ready', 'path': cube['path']}
+        if not build:
+            return {'status': 'missing'}
+        current = self.builds.get(fingerprint)
+        if current is not None:
+            if time.time() - current['started'] < BUILD_TIMEOUT:
+                return {'status': 'building'}
+            shutil.rmtree(current['path'], ignore_errors=True)
+        # the builder creates the directory itself, so that it owns it and nobody
+        # else can write to it; the path is unguessable, so nobody can create it first
+        token = uuid.uuid4().hex
+        path = self._path(fingerprint, token) + '.tmp'
+        self.builds[fingerprint] = {'path': path, 'token': token, 'started': time.time()}
+        return {'status': 'build', 'path': path, 'token': token}
+
+    def _publish(self, fingerprint, build):
+        path = self._path(fingerprint, build['token'])
+        try:
+            names = _private_files(build['path'])
+            if os.lstat(build['path']).st_uid == os.getuid():
+                os.rename(build['path'], path)
+            else:
+                # copy another user's directory, which only its owner can change
+                # or remove
+                os.mkdir(path)
+                for name in names:
+                    shutil.copyfile(os.path.join(build['path'], name),
+                                    os.path.join(path, name))
+            os.chmod(path, 0o755)
+        except (IOError, OSError, ValueError) as exc:
+            shutil.rmtree(path, ignore_errors=True)
+            shutil.rmtree(build['path'], ignore_errors=True)
+            return {'status': 'error', 'message': str(exc)}
+        nbytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        self.cubes[fingerprint] = {'path': path, 'nbytes': nbytes, 'last_used': time.time()}
+        self._evict(keep=fingerprint)
+        return {'status': 'ready', 'path': path}
+
+    def _evict(self, keep):
+        """Remove least recently used cubes, other than keep, while over budget."""
+        if self.max_bytes is None:
+            return
+        by_age = sorted(self.cubes, key=lambda f: self.cubes[f]['last_used'])
+        total = sum(cube['nbytes'] for cube in self.cubes.itervalues())
+        for fingerprint in by_age:
+            if total <= self.max_bytes:
+                break
+            if fingerprint == keep:
+                continue
+            cube = self.cubes.pop(fingerprint)
+            shutil.rmtree(cube['path'], ignore_errors=True)
+            total -= cube['nbytes']
+
+    def clear(self):
+        with self.lock:
+            for entry in self.cubes.values() + self.builds.values():
+                shutil.rmtree(entry['path'], ignore_errors=True)
+            self.cubes = {}
+            self.builds = {}
+
+
+def _private_files(path):
+    """Return the names of the files in the directory path, checking that it and
+    they are writable only by its owner, and that none of them is a link.
+
+    Raises:
+    ValueError if they aren't
+
+    """
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & 0o022:
+        raise ValueError('{} is not a private directory'.format(path))
+    names = os.listdir(path)
+    for name in names:
+        file_st = os.lstat(os.path.join(path, name))
+        if not stat.S_ISREG(file_st.st_mode) or file_st.st_mode & 0o022 or \
+                file_st.st_uid != st.st_uid:
+            raise ValueError('{} is not a private file'.format(name))
+    return names
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return      # e.g. another server checking whether this one is running
+        try:
+            message = json.loads(line)
+            reply = self.server.store.handle(message)
+        except Exception as exc:
+            reply = {'status': 'error', 'message': str(exc)}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+# SocketServer only defines UnixStreamServer on platforms with Unix sockets, e.g. not
+# Windows, where DetectorData instances with cache_socket decode their own cubes
+if hasattr(socket, 'AF_UNIX'):
+    class CacheServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        """The cache server. Call serve_forever() to run it, and shutdown() from another
+        thread then server_close() to stop it, which removes the cached cubes.
+
+        """
+        daemon_threads = True
+
+        def __init__(self, socket_path=DEFAULT_SOCKET, root=None, max_bytes=None):
+            """
+            Keyword arguments:
+            socket_path - path of the Unix socket to listen on. A stale socket file left
+                          by a server that exited is replaced, but socket.error is raised
+                          if another server is listening on it.
+            root - directory holding the cubes; by default a directory in /dev/shm, or
+                   in the temporary directory where /dev/shm doesn't exist
+            max_bytes - max no. of bytes of cubes held, see CubeStore
+
+            """
+            if root is None:
+                parent = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+                root = os.path.join(parent, 'sakura-cache-{}'.format(os.getpid()))
+            _remove_stale_socket(socket_path)
+            self.store = CubeStore(root, max_bytes)
+            SocketServer.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+            os.chmod(socket_path, 0o777)     # other users' Sakura processes may connect
+
+        def server_close(self):
+            SocketServer.UnixStreamServer.server_close(self)
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+            self.store.clear()
+            shutil.rmtree(self.store.root, ignore_errors=True)
+
+
+def _remove_stale_socket(socket_path):
+    """Remove the socket file socket_path if nothing is listening on it.
+
+    Raises:
+    socket.error if a server is listening on it or it isn't a socket
+
+    """
+    try:
+        st = os.lstat(socket_path)
+    except OSError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise socket.error('{} exists and is not a socket'.format(socket_path))
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except socket.error as exc:
+        if exc.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+    else:
+        raise socket.error('A cache server is already listening on {}'.format(
+            socket_path))
+    finally:
+        s.close()
+    os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    if not hasattr(socket, 'AF_UNIX'):
+        sys.exit('Unix sockets are not supported on this platform')
+    socket_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SOCKET
+    max_bytes = int(float(sys.argv[2]) * 1e6) if len(sys.argv) > 2 else None
+    server = CacheServer(socket_path, max_bytes=max_bytes)
+    print 'Sakura cache server listening on', socket_path, 'holding cubes in', \
+        server.store.root
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -37,18 +37,19 @@ class Config(object):
         configpath = os.path.join(confighome, '.sakura', 'config.ini')
         return configpath
 
-    def read_item(self, group, item):
+    def read_item(self, group, item, default=cfgparse.NO_DEFAULT):
         """Read the item.
 
         Keyword arguments:
         group - e.g. 'paths' refers to [paths]
         item - e.g. 'save_path'
+        default - optional value string used if the item isn't in the config file
     
         Returns:
         Item value parsed using the Python ast evaluator
 
         """
-        option = self.parser.add_option(item, keys=group, type='string')
+        option = self.parser.add_option(item, keys=group, type='string', default=default)
         val = option.get()
         try:
             val = ast.literal_eval(val)
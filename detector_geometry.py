@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2013-2014 Synchrotron Light Source Australia Pty Ltd.
+# Released under the Modified BSD license
+# See LICENSE
+
+"""
+Named multi-element detector geometries. A geometry holds the detector shape and the
+wiring of each detector element to a channel of an XMAP module read out by one of the
+IOCs, each of which writes one netCDF file per file group. The element -> (IOC, module,
+channel) maps are computed once, when the geometry is created, as read-only NumPy
+arrays indexed by element, i.e. row * cols + col, so readers only ever index them.
+
+Geometries are registered by name, e.g. get_geometry('100-element'). Other layouts,
+e.g. detectors with several hundred elements read out by several IOCs, can be added
+with register_geometry().
+
+"""
+
+import numpy as np
+
+CHANNELS_PER_MODULE = 4
+
+
+class DetectorGeometry(object):
+    """The layout of a multi-element detector and its XMAP modules."""
+    def __init__(self, name, shape, modules_per_ioc, element_channels=None):
+        """
+        Keyword arguments:
+        name - name the geometry is registered under, e.g. '100-element'
+        shape - tuple (rows, cols) of detector shape rows and cols
+        modules_per_ioc - sequence of the no. of XMAP modules read out by each IOC, in
+                 the order of the IOCs' filenames within a file group
+        element_channels - optional sequence of the channel wired to each element,
+                 numbered consecutively over the modules of all the IOCs, i.e.
+                 (sum of modules of earlier IOCs + module) * 4 + channel. By default
+                 element i is wired to channel i.
+
+        self.ioc_ix, self.module_ix, self.channel - (elements,) arrays of the IOC, i.e.
+            file within a file group, module within the IOC and channel within the
+            module of each element
+        self.elements_by_ioc - list of 1-D arrays of the elements read out by each IOC,
+            in increasing order
+
+        """
+        self.name = name
+        self.shape = tuple(shape)
+        self.rows, self.cols = self.shape
+        self.elements = self.rows * self.cols
+        self.modules_per_ioc = tuple(int(m) for m in modules_per_ioc)
+        channels = sum(self.modules_per_ioc) * CHANNELS_PER_MODULE
+        if element_channels is None:
+            element_channels = np.arange(self.elements)
+        element_channels = np.asarray(element_channels, dtype=np.intp)
+        if len(element_channels) != self.elements:
+            raise ValueError('{}: {} element channels given for {} elements'.format(
+                name, len(element_channels), self.elements))
+        if (element_channels < 0).any() or (element_channels >= channels).any() or \
+                len(np.unique(element_channels)) != self.elements:
+            raise ValueError('{}: element channels must be distinct and less than '
+                             '{}'.format(name, channels))
+
+        module, channel = np.divmod(element_channels, CHANNELS_PER_MODULE)
+        first_modules = np.cumsum((0,) + self.modules_per_ioc)
+        ioc_ix = np.searchsorted(first_modules, module, side='right') - 1
+        self.ioc_ix = _read_only(ioc_ix)
+        self.module_ix = _read_only(module - first_modules[ioc_ix])
+        self.channel = _read_only(channel)
+        self.elements_by_ioc = [_read_only(np.flatnonzero(ioc_ix == ioc))
+                                for ioc in range(len(self.modules_per_ioc))]
+
+    @classmethod
+    def sequential(cls, shape, iocs, name=None):
+        """Return the geometry of a detector whose elements are wired to consecutive
+        channels, with the modules split evenly across the IOCs in increasing order,
+        the last IOC taking any fewer.
+
+        """
+        elements = shape[0] * shape[1]
+        modules = -(-elements // CHANNELS_PER_MODULE)
+        per_ioc = -(-modules // iocs)
+        modules_per_ioc = [min(per_ioc, modules - per_ioc * ioc) for ioc in range(iocs)]
+        name = name or '{}x{} on {} IOCs'.format(shape[0], shape[1], iocs)
+        return cls(name, shape, [m for m in modules_per_ioc if m > 0])
+
+    @property
+    def iocs(self):
+        return len(self.modules_per_ioc)
+
+    def __repr__(self):
+        return '<DetectorGeometry {} {}x{}, modules per IOC {}>'.format(
+            self.name, self.rows, self.cols, self.modules_per_ioc)
+
+
+def _read_only(a):
+    a.flags.writeable = False
+    return a
+
+
+GEOMETRIES = {}
+
+
+def register_geometry(geometry):
+    """Register a DetectorGeometry under its name, replacing any of the same name, and
+    return it.
+
+    """
+    GEOMETRIES[geometry.name] = geometry
+    return geometry
+
+
+def get_geometry(geometry):
+    """Return the registered DetectorGeometry named geometry. A DetectorGeometry is
+    returned unchanged.
+
+    """
+    if isinstance(geometry, DetectorGeometry):
+        return geometry
+    try:
+        return GEOMETRIES[geometry]
+    except KeyError:
+        raise ValueError('Unknown detector geometry {!r}, expected one of {}'.format(
+            geometry, sorted(GEOMETRIES)))
+
+
+# the 36-element detector is read out by one IOC and the 100-element one by two
+register_geometry(DetectorGeometry('36-element', (6, 6), [9]))
+register_geometry(DetectorGeometry('100-element', (10, 10), [13, 12]))
@@ -764,7 +764,9 @@ def writeAverages(results, reader_type, detSize):
 
         # Write other notes here
         if reader_type == 'gnc':
-            # Write current ROIs if a mapping mode dataset
+            # Write current ROIs if a mapping mode dataset, in MCA bins regardless of
+            # any rebinning
+            rebin = results.det.detector_data.rebin
             print >>f, dedent("""\
                 #
                 #
@@ -775,8 +777,8 @@ def writeAverages(results, reader_type, detSize):
                 # roi_high: {roi_high}
                 #\
                 """.format(
-                    roi_low=results.det.roi_low,
-                    roi_high=results.det.roi_high
+                    roi_low=results.det.roi_low * rebin,
+                    roi_high=results.det.roi_high * rebin
                     ))
 
         # write data
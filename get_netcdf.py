@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 
 import os
+import multiprocessing
 import numpy as np
-from xmap_netcdf_reader import DetectorData
+from xmap_netcdf_reader import DetectorData, CubeBudget
 import readMDA
 
 from memoize_core import Memoizer
@@ -30,7 +31,10 @@ attribute syntax (self.det[i].fpeaks, self.det[i].speaks, self.det[i].roi), fpea
 speaks values are computed once and cached (@memoize decorator), and the roi value is
 computed and temporarily cached (@expiring_memoize decorator with 10s expiry).
 The roi value in particular is computed on the fly based on the roi limits (roi_low and
-roi_high) stored in the Detector instance (e.g. self.det.roi_low).
+roi_high) stored in the Detector instance (e.g. self.det.roi_low). When the DetectorData
+spectrum cube has been built, or deferred by DetectorData.load_statistics(), the roi
+values of all pixels come from a single DetectorData.roi_sums() call on its cumulative
+spectrum cube.
 
 """
 
@@ -47,7 +51,7 @@ class Pixel(object):
         # assign and increment unique id
         self.pixNum = Pixel.__pxId
         Pixel.__pxId += 1
-        self.row, self.col = divmod(self.pixNum, self.detector.rows)
+        self.row, self.col = divmod(self.pixNum, self.detector.cols)
         self.roiCorr = None
         self.roiCorrNorm = None
         self.weightedSpec = None
@@ -80,25 +84,36 @@ class Pixel(object):
 
     @expiring_memoize(max_age=10)
     def _roi(self, roi_low, roi_high):
-        data = np.array([self._GetSpectrumROI(step, roi_low, roi_high).sum()
-                         for step in self.detector.steprange])
-        data /= self.detector.ts
+        if self.detector_data.has_cube():
+            # gather from the ROI sums computed for all pixels at once
+            element = self.row * self.detector.cols + self.col
+            data = self.detector_data.roi_sums(roi_low, roi_high)[
+                self.detector.steprange, element]
+        else:
+            data = np.array([self._GetSpectrumROI(step, roi_low, roi_high).sum()
+                             for step in self.detector.steprange])
+        data = data / self.detector.ts
         return data
 
+    def _statistic_series(self, metric):
+        """Return the metric values for all steps in the detector steprange."""
+        # index straight into the bulk-decoded (steps, elements) array
+        element = self.row * self.detector.cols + self.col
+        statistics = self.detector_data.statistics_arrays()
+        return statistics[metric][self.detector.steprange, element]
+
     @property
     @memoize
     def fpeaks(self):
-        data = np.array([self.statistic(step, self.row, self.col, 'realtime')
-                        for step in self.detector.steprange])
-        data /= self.detector.ts
+        data = self._statistic_series('realtime')
+        data = data / self.detector.ts
         return data
 
     @property
     @memoize
     def speaks(self):
-        data = np.array([self.statistic(step, self.row, self.col, 'livetime')
-                        for step in self.detector.steprange])
-        data /= self.detector.ts
+        data = self._statistic_series('livetime')
+        data = data / self.detector.ts
         return data
 
     @property
@@ -179,6 +194,26 @@ class Detector(list):
         """Set sample times for NormT correction."""
         self.ts = ts
 
+    def window_counts(self, roi_low, roi_high, first_step=0, end_step=None, pixels=None):
+        """Return the total counts in MCA bins [roi_low, roi_high) over energy steps
+        [first_step, end_step) of each of the pixels, in constant time per pixel from
+        the summed-area table of the spectrum cube; see DetectorData.window_sums().
+
+        Keyword arguments:
+        roi_low, roi_high - semi-open range of MCA bins
+        first_step, end_step - semi-open range of energy steps, by default all of
+                               steprange
+        pixels - optional sequence of pixel ids, by default every pixel
+
+        Returns:
+        A 1-D array of the counts of each pixel
+
+        """
+        if end_step is None:
+            end_step = len(self.steprange)
+        return self.detector_data.window_sums(first_step, end_step, roi_low, roi_high,
+                                              pixels)
+
 
 def getAllExtraPVs(fname):
     """Return a dictionary of all "Extra" PVs, indexed by the part of the PV name
@@ -233,19 +268,42 @@ def highest_available_scandata(detector, scanSize):
     Raises IndexError if expected data is unavailable
 
     """
-    for i in range(scanSize):
-        try:
-            detector.det[0].pixel_header_mode1_item(i, 0, 0, 'tag0', check_validity=False)
-        except Exception as exc:
-            print 'netCDF data truncated', exc.message
-            i = i - 1
-            break
-    return i + 1
-
-
-def getData(fname):
+    statistics = detector.detector_data.statistics
+    if statistics is not None:
+        # the decoded arrays were truncated to the data that could be read
+        return min(scanSize, len(statistics['realtime']))
+
+    # otherwise peek at the file headers rather than reading the data
+    completeness = detector.detector_data.check_completeness()
+    available = min(completeness.values()) if completeness else 0
+    if available < scanSize:
+        print 'netCDF data truncated', completeness
+    return min(scanSize, available)
+
+
+def getData(fname, rebin=1, step_window=None, excluded_elements=None, sparse=False,
+            validate_blocks=False, report_io=False, geometry='36-element',
+            cache_socket=None, cube_budget=None):
     """Extract data from mda-ASCII file and distribute into Pixel objects
 
+    Keyword arguments:
+    fname - mda file path
+    rebin - no. of adjacent MCA bins summed into each spectrum bin, see DetectorData
+    step_window - optional (first, end) semi-open range of energy steps to load, where
+                  end may be None for the end of the scan, see DetectorData
+    excluded_elements - optional sequence of detector element (pixel) ids that are never
+                  read, e.g. dead channels, see DetectorData.set_element_mask()
+    sparse - if True, hold only the non-zero bins of the spectra, see DetectorData
+    validate_blocks - if True, check every pixel block's header as it is decoded,
+                  leaving the data of corrupt blocks zero, see DetectorData
+    report_io - if True, print the bytes read and the time spent opening, parsing and
+                  decoding the netCDF files, see DetectorData.io_stats()
+    geometry - name of the detector geometry, see detector_geometry.GEOMETRIES
+    cache_socket - optional socket path of a cache_server that shares decoded spectra
+                  between the Sakura processes on this host, see DetectorData
+    cube_budget - optional CubeBudget shared by the scans loaded in a session, which
+                  limits the bytes their decoded spectra hold together
+
     Returns: XAS scan data in a detector 'object' (variable "det")
             energy axis, transmission data array and detector filled with fluo data
     (detector object simply full of '0' values if no fluorescence data available)
@@ -261,12 +319,26 @@ def getData(fname):
     netcdf_filepattern = '{}_([0-9]*)\.nc'.format(netcdf_basename)
 
     scanData = mda[1]
-    scanSize = scanData.npts
+    first_step, end_step = step_window or (0, None)
+    scanSize = len(range(scanData.npts)[first_step:end_step])
 
     # create and set the reader for the fluorescence detector
-    detector_data = DetectorData(shape=(6, 6), pixelsteps_per_buffer=1,
-        buffers_per_file=1, dirpaths=netcdf_directory,
-        filepattern=netcdf_filepattern, mca_bins=2048, first_file_n=1)
+    # the buffer layout is read from the first netCDF file
+    detector_data = DetectorData(shape=None, pixelsteps_per_buffer=None,
+        buffers_per_file=None, dirpaths=netcdf_directory,
+        filepattern=netcdf_filepattern, mca_bins=2048, first_file_n=1, rebin=rebin,
+        step_window=(first_step, end_step), sparse=sparse,
+        validate_blocks=validate_blocks, report_io=report_io, geometry=geometry,
+        cache_socket=cache_socket, cube_budget=cube_budget)
+    if excluded_elements:
+        element_mask = np.zeros(detector_data.rows * detector_data.cols, dtype=bool)
+        element_mask[list(excluded_elements)] = True
+        detector_data.set_element_mask(element_mask)
+    # decode just the pixel header statistics up front, reading files concurrently; the
+    # dense spectrum cube is decoded when the spectra are first needed, or both are
+    # mapped from the sidecar file written next to the mda file by an earlier load
+    detector_data.load_statistics(workers=multiprocessing.cpu_count(),
+                                  sidecar=os.path.splitext(fname)[0] + '.cube')
 
     detector = Detector(detector_data)
 
@@ -285,7 +357,8 @@ def getData(fname):
         try:
             tag = ':'.join(series.name.split(':')[1:])  # use the PV part after the IOC id
             if tag in pvColumnNames:
-                trans[pvColumnNames.index(tag)] = series.data[:scanSize]
+                trans[pvColumnNames.index(tag)] = \
+                    series.data[first_step:first_step + scanSize]
         except Exception as e:
             print e
             print 'missing PV ' + tag
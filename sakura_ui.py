@@ -113,6 +113,39 @@ class SakuraBaseMainFrame( sakura_gui_autogenerated.MainFrame ):
 
         # config file
         self.config = config.Config()
+        # no. of adjacent MCA bins summed into each bin of netCDF-based spectra
+        self.mca_rebin = self.config.read_item(group='netcdf', item='mca_rebin',
+                                               default='1')
+        # (first, end) range of energy steps loaded from netCDF-based datasets, e.g.
+        # (0, 150) for the XANES region only; None loads every step
+        self.step_window = self.config.read_item(group='netcdf', item='step_window',
+                                                 default='None')
+        # ids of dead pixels never read from netCDF-based datasets, e.g. [3, 17]
+        self.excluded_elements = self.config.read_item(
+            group='netcdf', item='excluded_elements', default='None')
+        # hold only the non-zero bins of netCDF-based spectra, to save memory
+        self.sparse_spectra = self.config.read_item(
+            group='netcdf', item='sparse_spectra', default='False')
+        # check the header of every netCDF pixel block, zeroing corrupt ones
+        self.validate_blocks = self.config.read_item(
+            group='netcdf', item='validate_blocks', default='False')
+        # print the netCDF file I/O done by each load, e.g. to size NFS mounts
+        self.report_io = self.config.read_item(
+            group='netcdf', item='report_io', default='False')
+        # name of the detector geometry of netCDF-based datasets, e.g. '100-element'
+        self.detector_geometry = self.config.read_item(
+            group='netcdf', item='detector_geometry', default='36-element')
+        # socket of a cache_server sharing decoded netCDF spectra between Sakura
+        # processes, e.g. '/tmp/sakura-cache.sock'; None decodes every scan itself
+        self.cache_socket = self.config.read_item(
+            group='netcdf', item='cache_socket', default='None')
+        # max MB of decoded netCDF spectra held by all the open scans together; the
+        # least recently used scans release theirs beyond it. None is unlimited.
+        cube_megabytes = self.config.read_item(
+            group='netcdf', item='cube_megabytes', default='None')
+        self.cube_budget = None
+        if cube_megabytes is not None:
+            self.cube_budget = gnc.CubeBudget(int(cube_megabytes * 1e6))
 
 
     def make_canvas(self, canvas_name, parent_panel):
@@ -1048,7 +1081,7 @@ class SakuraBaseMainFrame( sakura_gui_autogenerated.MainFrame ):
             self.m_StepSpinCtrl.SetValue(maxval)
 
             # set ROI widget ranges
-            maxval = self.det.detector_data.mca_bins
+            maxval = self.det.detector_data.bins
             self.m_RoiLowSlider.SetMax(maxval)
             self.m_RoiHighSlider.SetMax(maxval)
             self.m_RoiLowSpinCtrl.SetRange(1, maxval)
@@ -1144,7 +1177,7 @@ class SakuraBaseMainFrame( sakura_gui_autogenerated.MainFrame ):
             ##line = plot.PolyLine([(0,1), (self.det.detector_data.mca_bins-1,1)],
             ##                     colour='white', width=1)
             if MCA_XRF is not None :
-                line = plot.PolyLine([(0,1), (self.det.detector_data.mca_bins-1,1)],
+                line = plot.PolyLine([(0,1), (self.det.detector_data.bins-1,1)],
                                      colour='white', width=0)
                 series.append(line)
 
@@ -1228,9 +1261,10 @@ class SakuraBaseMainFrame( sakura_gui_autogenerated.MainFrame ):
         except KeyError:
             pv_dict['mca1.R0HI'] = ('long', '', [800])
 
-        # start with this roi range
-        self.det.roi_low = pv_dict['mca1.R0LO'][-1][0]
-        self.det.roi_high = pv_dict['mca1.R0HI'][-1][0]
+        # start with this roi range, converting MCA bins to rebinned spectrum bins
+        rebin = self.det.detector_data.rebin
+        self.det.roi_low = pv_dict['mca1.R0LO'][-1][0] // rebin
+        self.det.roi_high = -(-pv_dict['mca1.R0HI'][-1][0] // rebin)
 
     def readData(self, whichFileToProcess):
         """Called on file load to generate required data structures.
@@ -1239,7 +1273,19 @@ class SakuraBaseMainFrame( sakura_gui_autogenerated.MainFrame ):
         #   transmission data (trans=data[1]), and
         #   "detector" (list of pixel objects; see "get_mda.py" for details) (det=data[2])
         # if detector size is different from existing size, skip reading
-        e, trans, det = self.reader.getData(whichFileToProcess)
+        if self.reader == gnc:
+            e, trans, det = self.reader.getData(whichFileToProcess,
+                                                rebin=self.mca_rebin,
+                                                step_window=self.step_window,
+                                                excluded_elements=self.excluded_elements,
+                                                sparse=self.sparse_spectra,
+                                                validate_blocks=self.validate_blocks,
+                                                report_io=self.report_io,
+                                                geometry=self.detector_geometry,
+                                                cache_socket=self.cache_socket,
+                                                cube_budget=self.cube_budget)
+        else:
+            e, trans, det = self.reader.getData(whichFileToProcess)
 
         if hasattr(self, 'detSize') and len(det) != self.detSize:
             print ("Error: Loaded detector size (%i) is different " +
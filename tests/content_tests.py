@@ -2,12 +2,19 @@ import unittest
 import nose
 from nose.tools import eq_, ok_
 import os, sys
+import shutil
+import socket
+import threading
+import tempfile
+import numpy as np
 
 PATH_HERE = os.path.abspath(os.path.dirname(__file__))
 sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
 
 import readMDA
-from xmap_netcdf_reader import DetectorData
+from xmap_netcdf_reader import DetectorData, CubeBudget, read_export
+from cache_server import CacheServer
+from detector_geometry import DetectorGeometry
 
 TESTDATA_DIR = os.path.join(PATH_HERE, '..', '..', 'test_data', '2013-07-26_mapping_mode')
 MDA_FILE = 'SR12ID01H22707.mda'
@@ -47,5 +54,332 @@ class DetectorTest(unittest.TestCase):
         stat = self.d.statistic(pixel_step, row, col, 'realtime')
         self.assertEqual(stat, 3125023)
 
+    def mmap_spectrum_test(self):
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            use_mmap = True,
+            max_open_files = 2,
+        )
+        spectrum = d.spectrum(0, 0, 0)
+        self.assertFalse(spectrum.flags.writeable)
+        self.assertEqual(spectrum.sum(), 5445)
+        self.assertEqual(d.spectrum(538, 9, 9).sum(), 155276)
+        d.close()
+        self.assertEqual(len(d.module_data_cache), 0)
+
+    def cache_budget_test(self):
+        group_bytes = 25 * (256 + 4 * 2048) * 2    # 25 modules in each file group
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            cache_bytes = 2 * group_bytes,
+        )
+        for pixel_step in range(5):
+            d.spectrum(pixel_step, 0, 0)
+            d.spectrum(pixel_step, 9, 9)
+        self.assertEqual(d.module_data_cache.nbytes, 2 * group_bytes)
+        self.assertEqual(len(d.module_data_cache), 2 * 100)
+        # evicted data is read again transparently
+        self.assertEqual(d.spectrum(0, 0, 0).sum(), 5445)
+
+    def preload_test(self):
+        self.d.preload(steps=[0, 538], workers=4)
+        self.assertEqual(len(self.d.module_data_cache), 2 * 100)
+        self.assertEqual(self.d.spectrum(0, 0, 0).sum(), 5445)
+        self.assertEqual(self.d.spectrum(538, 9, 9).sum(), 155276)
+
+    def preload_mmap_test(self):
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            use_mmap = True,
+            max_open_files = 4,
+        )
+        d.preload(workers=4)
+        # only as many files as the pool holds open, those of the first 2 steps
+        self.assertEqual(len(d.mapped_files.files), 4)
+        self.assertEqual(len(d.module_data_cache), 2 * 100)
+        self.assertEqual(d.spectrum(0, 0, 0).sum(), 5445)
+
+    def statistics_arrays_test(self):
+        stats = self.d.statistics_arrays()
+        self.assertEqual(stats['realtime'].shape, (539, 100))
+        self.assertEqual(stats['realtime'][0, 0], 3125023)
+        self.assertTrue(self.d.spectra is None)
+        for metric in ['livetime', 'triggers', 'output_events']:
+            self.assertEqual(stats[metric][538, 99],
+                             self.d.statistic(538, 9, 9, metric))
+
+    def cube_shape_test(self):
+        cube = self.d.cube()
+        self.assertEqual(cube.shape, (539, 100, 2048))
+        self.assertEqual(self.d.statistics['realtime'].shape, (539, 100))
+
+    def cube_spectrum_test(self):
+        self.d.cube(workers=4)
+        self.assertEqual(self.d.spectrum(0, 0, 0).sum(), 5445)
+        self.assertEqual(self.d.spectrum(538, 9, 9).sum(), 155276)
+
+    def roi_sums_test(self):
+        sums = self.d.roi_sums(0, 2048)
+        self.assertEqual(sums.shape, (539, 100))
+        self.assertEqual(sums[0, 0], 5445)
+        self.assertEqual(sums[538, 99], 155276)
+        self.assertEqual(self.d.roi_sums(600, 800)[0, 0],
+                         self.d.spectrum(0, 0, 0)[600:800].sum())
+
+    def sidecar_test(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sidecar = os.path.join(tmpdir, 'scan.cube')
+            cube = self.d.cube(sidecar=sidecar)
+            self.assertTrue(os.path.exists(sidecar))
+            d = DetectorData(
+                shape = (10,10),
+                pixelsteps_per_buffer = 1,
+                buffers_per_file = 1,
+                dirpaths = NETCDF_DIR,
+                filepattern = NETCDF_PATTERN,
+                mca_bins = 2048,
+                first_file_n = 1,
+            )
+            mapped = d.cube(sidecar=sidecar)
+            self.assertFalse(mapped.flags.writeable)
+            self.assertEqual(mapped.shape, cube.shape)
+            self.assertEqual(d.spectrum(538, 9, 9).sum(), 155276)
+            self.assertEqual(d.statistic(0, 0, 0, 'realtime'), 3125023)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def sidecar_geometry_test(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sidecar = os.path.join(tmpdir, 'scan.cube')
+            self.d.cube(sidecar=sidecar)
+            # the same files, with the elements wired in reverse order
+            reversed_wiring = DetectorGeometry('reversed', (10, 10), [13, 12],
+                                               np.arange(100)[::-1])
+            d = DetectorData(
+                shape = None,
+                pixelsteps_per_buffer = 1,
+                buffers_per_file = 1,
+                dirpaths = NETCDF_DIR,
+                filepattern = NETCDF_PATTERN,
+                mca_bins = 2048,
+                first_file_n = 1,
+                geometry = reversed_wiring,
+            )
+            self.assertNotEqual(d.fingerprint(), self.d.fingerprint())
+            # the sidecar is rewritten rather than mapped
+            self.assertTrue(d.cube(sidecar=sidecar).flags.writeable)
+            self.assertEqual(d.spectrum(538, 0, 0).sum(), 155276)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def sidecar_validate_blocks_test(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            sidecar = os.path.join(tmpdir, 'scan.cube')
+            self.d.cube(sidecar=sidecar)
+            # a cube decoded without validating the blocks isn't reused with it
+            d = DetectorData(
+                shape = (10,10),
+                pixelsteps_per_buffer = 1,
+                buffers_per_file = 1,
+                dirpaths = NETCDF_DIR,
+                filepattern = NETCDF_PATTERN,
+                mca_bins = 2048,
+                first_file_n = 1,
+                validate_blocks = True,
+            )
+            self.assertNotEqual(d.fingerprint(), self.d.fingerprint())
+            self.assertTrue(d.cube(sidecar=sidecar).flags.writeable)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def export_test(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.d.export(tmpdir)
+            descriptor, arrays = read_export(tmpdir)
+            self.assertEqual(descriptor['detector_shape'], [10, 10])
+            spectra = np.load(os.path.join(tmpdir, 'spectra.npy'), mmap_mode='r')
+            self.assertEqual(spectra.shape, (539, 100, 2048))
+            self.assertEqual(spectra[538, 99].sum(), 155276)
+            self.assertEqual(arrays['realtime'][0, 0], 3125023)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def cube_budget_test(self):
+        budget = CubeBudget(int(1.5 * self.d.cube().nbytes))
+        make = lambda: DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            cube_budget = budget,
+        )
+        first, second = make(), make()
+        first.cube()
+        second.cube()
+        # the least recently used cube is released, keeping its statistics
+        self.assertTrue(first.spectra is None)
+        self.assertTrue(first.statistics is not None)
+        self.assertTrue(budget.nbytes() <= budget.max_bytes)
+        # and is built again on its next use, releasing the other
+        self.assertEqual(first.spectrum(538, 9, 9).sum(), 155276)
+        self.assertTrue(second.spectra is None)
+
+    def cube_statistic_test(self):
+        self.d.cube()
+        self.assertEqual(self.d.statistic(0, 0, 0, 'realtime'), 3125023)
+
+    def load_statistics_test(self):
+        self.d.load_statistics()
+        self.assertTrue(self.d.spectra is None)
+        self.assertTrue(self.d.has_cube())
+        self.assertEqual(self.d.statistic(0, 0, 0, 'realtime'), 3125023)
+        # the spectra are decoded on first use
+        self.assertEqual(self.d.spectrum(538, 9, 9).sum(), 155276)
+        self.assertTrue(self.d.spectra is not None)
+
+    def rebin_test(self):
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            rebin = 4,
+        )
+        spectrum = d.spectrum(538, 9, 9)
+        self.assertEqual(len(spectrum), 512)
+        self.assertEqual(spectrum.sum(), 155276)
+        self.assertTrue((d.cube()[538, 99] == spectrum).all())
+
+    def step_window_test(self):
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            step_window = (500, None),
+        )
+        self.assertEqual(d.spectrum(38, 9, 9).sum(), 155276)
+        self.assertEqual(d.cube().shape, (39, 100, 2048))
+        self.assertEqual(d.cube()[38, 99].sum(), 155276)
+
+    def element_mask_test(self):
+        element_mask = np.zeros(100, dtype=bool)
+        element_mask[52:] = True    # every element in the ioc54 files
+        self.d.set_element_mask(element_mask)
+        cube = self.d.cube()
+        self.assertEqual(cube[0, 0].sum(), 5445)
+        self.assertEqual(cube[538, 99].sum(), 0)
+        self.assertEqual(self.d.statistics['realtime'][0, 99], 0)
+
+    def element_mask_skips_modules_test(self):
+        element_mask = np.ones(100, dtype=bool)
+        element_mask[:4] = False    # the first module of the ioc53 files only
+        self.d.set_element_mask(element_mask)
+        cube = self.d.cube()
+        self.assertEqual(cube[0, 0].sum(), 5445)
+        # just the pages of the unmasked module are read
+        file_size = os.path.getsize(os.path.join(NETCDF_DIR, 'ioc53_1.nc'))
+        self.assertTrue(self.d.io_stats()['bytes_read'] < 539 * file_size / 10)
+
+    def sparse_cube_test(self):
+        d = DetectorData(
+            shape = (10,10),
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            sparse = True,
+        )
+        d.cube()
+        self.assertEqual(d.spectrum(0, 0, 0).sum(), 5445)
+        self.assertEqual(d.spectrum(538, 9, 9).sum(), 155276)
+        self.assertTrue((d.roi_sums(600, 800) == self.d.roi_sums(600, 800)).all())
+
+    def window_sums_test(self):
+        elements = [0, 7, 42, 99]
+        sums = self.d.window_sums(100, 300, 600, 800, elements)
+        cube = self.d.cube()
+        for element, total in zip(elements, sums):
+            self.assertEqual(total, cube[100:300, element, 600:800].sum(dtype=np.uint64))
+        self.assertEqual(self.d.window_sums(0, 1, 0, 2048, [0])[0], 5445)
+
+    def cube_on_decoded_test(self):
+        decoded = []
+        def on_decoded(first, end, spectra, statistics):
+            decoded.append((first, end, int(spectra[first, 0].sum())))
+        self.d.cube(workers=4, on_decoded=on_decoded)
+        # one call per file group, in pixel_step order
+        self.assertEqual([(first, end) for first, end, _ in decoded],
+                         [(step, step + 1) for step in range(539)])
+        self.assertEqual(decoded[0][2], 5445)
+
+    def cache_server_test(self):
+        tmpdir = tempfile.mkdtemp()
+        server = CacheServer(os.path.join(tmpdir, 'cache.sock'),
+                             root=os.path.join(tmpdir, 'cubes'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            make = lambda: DetectorData(
+                shape = (10,10),
+                pixelsteps_per_buffer = 1,
+                buffers_per_file = 1,
+                dirpaths = NETCDF_DIR,
+                filepattern = NETCDF_PATTERN,
+                mca_bins = 2048,
+                first_file_n = 1,
+                cache_socket = server.server_address,
+            )
+            first = make()
+            first.cube()
+            # the first instance maps the server's copy rather than keeping its own
+            self.assertTrue(isinstance(first.spectra, np.memmap))
+            # a second instance maps the first one's cube without reading the files
+            d = make()
+            self.assertEqual(d.cube()[538, 99].sum(), 155276)
+            self.assertTrue(isinstance(d.spectra, np.memmap))
+            self.assertEqual(d.io_stats()['opens'], 0)
+            # the socket of a running server isn't taken over
+            self.assertRaises(socket.error, CacheServer, server.server_address,
+                              root=os.path.join(tmpdir, 'other'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     nose.run(defaultTest=__name__)
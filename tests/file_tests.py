@@ -2,12 +2,19 @@ import unittest
 import nose
 from nose.tools import eq_, ok_
 import os, sys
+import shutil
+import tempfile
+import threading
 
 PATH_HERE = os.path.abspath(os.path.dirname(__file__))
 sys.path = [os.path.join(PATH_HERE, '..')] + sys.path
 
 import readMDA
-from xmap_netcdf_reader import DetectorData
+import numpy as np
+from xmap_netcdf_reader import DetectorData, ArrayDataFile, CubeBudget, SparseSpectra
+from xmap_netcdf_reader import netcdf_file
+from cache_server import CacheServer
+from xmap_netcdf_reader import validate_mode1_pixel_blocks, pixel_number_offset
 
 TESTDATA_DIR = os.path.join(PATH_HERE, '..', '..', 'test_data', '2013-07-26_mapping_mode')
 MDA_FILE = 'SR12ID01H22707.mda'
@@ -18,6 +25,71 @@ NETCDF_PATTERN = 'ioc5[3-4]_([0-9]*)\.nc'
 code. Changes to test_data.xml will cause failures in these tests.
 '''
 
+
+def generated_spectrum(pixel_step, element, bins):
+    return ((pixel_step * 7 + element * 3 + np.arange(bins)) % 50).astype(np.uint16)
+
+
+def generated_statistics(pixel_step, element):
+    return {'realtime': 3000000 + pixel_step * 1000 + element,
+            'livetime': 2000000 + pixel_step * 100 + element,
+            'triggers': 100000 + pixel_step + element * 65536,
+            'output_events': 50000 + pixel_step * 3 + element}
+
+
+def write_mode1_files(dirpath, pixel_steps, pixelsteps_per_buffer, buffers_per_file,
+                      bins, iocs=('ioc53', 'ioc54'), elements=100,
+                      spectrum=generated_spectrum):
+    """Write XMAP mapping mode 1 netCDF files ioc53_<n>.nc and ioc54_<n>.nc holding
+    spectrum() and generated_statistics() of every pixel_step, with array_data along
+    the record dimension as the XMAP IOC writes it.
+
+    """
+    split_words = lambda value: (value & 0xffff, value >> 16)
+    modules = elements // 4
+    modules_per_ioc = -(-modules // len(iocs))
+    block_size = 256 + 4 * bins
+    steps_per_file = pixelsteps_per_buffer * buffers_per_file
+    for file_ix in range(-(-pixel_steps // steps_per_file)):
+        for ioc_ix, ioc in enumerate(iocs):
+            file_modules = range(ioc_ix * modules_per_ioc,
+                                 min(modules, (ioc_ix + 1) * modules_per_ioc))
+            array_data = np.zeros((buffers_per_file, len(file_modules),
+                                   256 + pixelsteps_per_buffer * block_size), np.uint16)
+            for buffer_ix in range(buffers_per_file):
+                first_step = file_ix * steps_per_file + buffer_ix * pixelsteps_per_buffer
+                steps = range(first_step,
+                              min(pixel_steps, first_step + pixelsteps_per_buffer))
+                for module_ix, module in enumerate(file_modules):
+                    buf = array_data[buffer_ix, module_ix]
+                    buf[:4] = [0x55AA, 0xAA55, 256, 1]
+                    buf[8] = len(steps)
+                    buf[9:11] = split_words(first_step)
+                    for i, pixel_step in enumerate(steps):
+                        block = buf[256 + i * block_size:256 + (i + 1) * block_size]
+                        block[:4] = [0x33CC, 0xCC33, 256, 1]
+                        block[4:6] = split_words(pixel_step)
+                        block[6:8] = split_words(block_size)
+                        block[8:12] = bins
+                        for channel in range(4):
+                            element = module * 4 + channel
+                            stats = generated_statistics(pixel_step, element)
+                            for j, metric in enumerate(['realtime', 'livetime',
+                                                        'triggers', 'output_events']):
+                                offset = 32 + channel * 8 + j * 2
+                                block[offset:offset + 2] = split_words(stats[metric])
+                            block[256 + channel * bins:256 + (channel + 1) * bins] = \
+                                spectrum(pixel_step, element, bins)
+            path = os.path.join(dirpath, '{}_{}.nc'.format(ioc, file_ix + 1))
+            f = netcdf_file(path, 'w')
+            f.createDimension('numArrays', None)
+            f.createDimension('dim0', len(file_modules))
+            f.createDimension('dim1', array_data.shape[2])
+            f.createVariable('array_data', 'h', ('numArrays', 'dim0', 'dim1'))
+            f.variables['array_data'][:] = array_data.view(np.int16)
+            f.close()
+
+
 class DatasetLoadingTest(unittest.TestCase):
     def simple_load_test(self):
         fname = os.path.join(TESTDATA_DIR, MDA_FILE)
@@ -88,6 +160,34 @@ class DetectorTest(unittest.TestCase):
             self.assertTrue(isinstance(path, basestring))
             self.assertEqual((buffer_ix, module_ix, channel), output)
 
+    def location_tables_test(self):
+        for table in [self.d.file_ix, self.d.buffer_ix, self.d.pixel_ix,
+                      self.d.module_ix, self.d.channel]:
+            self.assertEqual(table.shape, (539, 100))
+        self.assertEqual(len(self.d.file_groups), 539)
+        self.assertEqual(self.d.file_groups[538], 539)
+        # element 51 is the last of the first file, 52 the first of the second
+        self.assertEqual((self.d.file_ix[0, 51], self.d.module_ix[0, 51],
+                          self.d.channel[0, 51]), (0, 12, 3))
+        self.assertEqual((self.d.file_ix[0, 52], self.d.module_ix[0, 52],
+                          self.d.channel[0, 52]), (1, 0, 0))
+
+    def geometry_test(self):
+        d = DetectorData(
+            shape = None,
+            pixelsteps_per_buffer = 1,
+            buffers_per_file = 1,
+            dirpaths = NETCDF_DIR,
+            filepattern = NETCDF_PATTERN,
+            mca_bins = 2048,
+            first_file_n = 1,
+            geometry = '100-element',
+        )
+        self.assertEqual(d.shape, (10, 10))
+        for table in ['file_ix', 'module_ix', 'channel']:
+            self.assertTrue((getattr(d, table) == getattr(self.d, table)).all())
+        self.assertEqual(d._get_data_location(0, 9, 9), self.d._get_data_location(0, 9, 9))
+
     def enumerate_all_data_indices_in_file_test(self):
         tests = [
             # filename, no. of elements in file,
@@ -102,5 +202,294 @@ class DetectorTest(unittest.TestCase):
             self.assertEqual(d[0], first)
             self.assertEqual(d[-1], last)
 
+    def refresh_without_new_files_test(self):
+        steps = []
+        self.d.add_listener(steps.extend)
+        self.assertEqual(self.d.refresh(), [])
+        self.assertEqual(self.d.refresh(), [])
+        self.assertEqual(steps, [])
+        self.assertEqual(len(self.d.files_indexed_by_pixel_step), 539)
+
+    def refresh_new_files_test(self):
+        for sparse in [False, True]:
+            tmpdir = tempfile.mkdtemp()
+            try:
+                copy_group = lambda file_n: [
+                    shutil.copy(os.path.join(NETCDF_DIR, '{}_{}.nc'.format(ioc, file_n)),
+                                tmpdir) for ioc in ['ioc53', 'ioc54']]
+                for file_n in range(1, 4):
+                    copy_group(file_n)
+                d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=1,
+                                 buffers_per_file=1, dirpaths=tmpdir,
+                                 filepattern=NETCDF_PATTERN, mca_bins=2048,
+                                 first_file_n=1, sparse=sparse)
+                spectra = d.cube()
+                d.roi_sums(0, 2048)
+                copy_group(4)
+                # a group is added once its sizes are unchanged since the last refresh
+                self.assertEqual(d.refresh(), [])
+                self.assertEqual(d.refresh(), [3])
+                # the new step is decoded into a copy, leaving the old arrays intact
+                self.assertEqual(len(spectra), 3)
+                self.assertEqual(len(d.cube()), 4)
+                self.assertEqual(len(d.statistics['realtime']), 4)
+                self.assertTrue((d.spectrum(3, 9, 9) == self.d.spectrum(3, 9, 9)).all())
+                self.assertEqual(d.statistic(3, 9, 9, 'realtime'),
+                                 self.d.statistic(3, 9, 9, 'realtime'))
+                self.assertTrue((d.roi_sums(0, 2048)[3] == self.d.roi_sums(0, 2048)[3]).all())
+            finally:
+                shutil.rmtree(tmpdir)
+
+    def detect_buffer_layout_test(self):
+        d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=None,
+                         buffers_per_file=None, dirpaths=NETCDF_DIR,
+                         filepattern=NETCDF_PATTERN, mca_bins=2048, first_file_n=1)
+        self.assertEqual((d.pixelsteps_per_buffer, d.buffers_per_file), (1, 1))
+        self.assertEqual(d.pixel_ix.shape, (539, 100))
+
+    def array_data_file_test(self):
+        path = os.path.join(NETCDF_DIR, 'ioc54_539.nc')
+        expected = netcdf_file(path, 'r', mmap=False).variables['array_data'][:]
+        for use_mmap in [False, True]:
+            array_data = ArrayDataFile(path, use_mmap).variables['array_data']
+            self.assertEqual(array_data.dtype, expected.dtype)
+            self.assertEqual(array_data.shape, expected.shape)
+            self.assertTrue((array_data == expected).all())
+
+    def layout_reuse_test(self):
+        first = self.d._open_file(os.path.join(NETCDF_DIR, 'ioc53_1.nc'))
+        later = self.d._open_file(os.path.join(NETCDF_DIR, 'ioc53_538.nc'))
+        self.assertTrue(later.layout is first.layout)
+        other = self.d._open_file(os.path.join(NETCDF_DIR, 'ioc54_1.nc'))
+        self.assertTrue(other.layout is not first.layout)
+        self.assertEqual(sorted(self.d.layouts), ['ioc53_.nc', 'ioc54_.nc'])
+
+    def check_completeness_test(self):
+        self.assertEqual(self.d.check_completeness(),
+                         {'ioc53_.nc': 539, 'ioc54_.nc': 539})
+        # a scan whose last ioc54 file has only part of its netCDF header written
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for file_n in range(1, 4):
+                for ioc in ['ioc53', 'ioc54']:
+                    shutil.copy(os.path.join(NETCDF_DIR, '{}_{}.nc'.format(ioc, file_n)),
+                                tmpdir)
+            last = os.path.join(tmpdir, 'ioc54_3.nc')
+            for size in [3, 20, 100]:
+                with open(last, 'r+b') as f:
+                    f.truncate(size)
+                d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=1,
+                                 buffers_per_file=1, dirpaths=tmpdir,
+                                 filepattern=NETCDF_PATTERN, mca_bins=2048,
+                                 first_file_n=1)
+                self.assertEqual(d.check_completeness(),
+                                 {'ioc53_.nc': 3, 'ioc54_.nc': 2})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def io_stats_test(self):
+        self.d.spectrum(0, 0, 0)
+        self.d.spectrum(0, 0, 1)
+        stats, files = self.d.io_stats(per_file=True)
+        self.assertEqual(stats['cache_misses'], 1)
+        self.assertEqual(stats['cache_hits'], 1)
+        self.assertEqual(files['ioc53_1.nc']['bytes_read'],
+                         os.path.getsize(os.path.join(NETCDF_DIR, 'ioc53_1.nc')))
+
+    def validate_test(self):
+        validity = self.d.validate()
+        self.assertEqual(validity.shape[1], 100)
+        self.assertTrue(validity.all())
+
+    def validate_mode1_pixel_blocks_test(self):
+        # 3 steps of 2 modules of good pixel headers, numbered from 10
+        blocks = np.zeros((3, 2, 12), dtype=np.uint16)
+        blocks[..., :4] = [0x33CC, 0xCC33, 256, 1]
+        blocks[..., 4] = (np.arange(3) + 10)[:, np.newaxis]
+        blocks[..., 6] = 256 + 4 * 2048 & 0xFFFF
+        blocks[..., 8:12] = 2048
+        self.assertTrue(validate_mode1_pixel_blocks(blocks, 2048, range(3))['valid'].all())
+        blocks[0, 1, 0] = 0         # missing
+        blocks[1, 0, 4] = 7         # out of order
+        blocks[2, 1, 9] = 1024      # ch1_size mismatch
+        problems = validate_mode1_pixel_blocks(blocks, 2048, range(3))
+        eq_(np.argwhere(problems['tags']).tolist(), [[0, 1]])
+        eq_(np.argwhere(problems['pixel_number']).tolist(), [[1, 0]])
+        eq_(np.argwhere(problems['channel_size']).tolist(), [[2, 1, 1]])
+        eq_(np.argwhere(~problems['valid']).tolist(),
+            [[0, 4], [0, 5], [0, 6], [0, 7], [1, 0], [1, 1], [1, 2], [1, 3], [2, 5]])
+        eq_(pixel_number_offset(blocks, range(3)), 10)
+        # blocks all numbered one pixel on only fail against the scan's numbering
+        blocks = np.zeros((3, 2, 12), dtype=np.uint16)
+        blocks[..., :4] = [0x33CC, 0xCC33, 256, 1]
+        blocks[..., 4] = (np.arange(3) + 11)[:, np.newaxis]
+        blocks[..., 6] = 256 + 4 * 2048 & 0xFFFF
+        blocks[..., 8:12] = 2048
+        self.assertTrue(validate_mode1_pixel_blocks(blocks, 2048, range(3))['valid'].all())
+        problems = validate_mode1_pixel_blocks(blocks, 2048, range(3), offset=10)
+        self.assertTrue(problems['pixel_number'].all())
+
+
+class GeneratedFileTest(unittest.TestCase):
+    """Small generated scans, with buffers of several pixels and files of several
+    buffers, which the test data doesn't have, the last buffers of the last files
+    partly filled.
+
+    """
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        write_mode1_files(self.dirpath, pixel_steps=14, pixelsteps_per_buffer=3,
+                          buffers_per_file=2, bins=64)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def multi_pixel_buffers_test(self):
+        for layout in [(3, 2), (None, None)]:
+            d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=layout[0],
+                             buffers_per_file=layout[1], dirpaths=self.dirpath,
+                             filepattern=NETCDF_PATTERN, mca_bins=64, first_file_n=1)
+            self.assertEqual((d.pixelsteps_per_buffer, d.buffers_per_file), (3, 2))
+            for pixel_step in [0, 2, 3, 5, 6, 13]:
+                for element in [0, 51, 52, 99]:
+                    row, col = divmod(element, 10)
+                    self.assertTrue((d.spectrum(pixel_step, row, col) ==
+                                     generated_spectrum(pixel_step, element, 64)).all())
+                    self.assertEqual(d.statistic(pixel_step, row, col, 'triggers'),
+                                     generated_statistics(pixel_step, element)['triggers'])
+            cube = d.cube()
+            self.assertEqual(cube.shape, (14, 100, 64))
+            for pixel_step in range(14):
+                for element in range(100):
+                    self.assertTrue((cube[pixel_step, element] ==
+                                     generated_spectrum(pixel_step, element, 64)).all())
+                    stats = generated_statistics(pixel_step, element)
+                    for metric in stats:
+                        self.assertEqual(d.statistics[metric][pixel_step, element],
+                                         stats[metric])
+
+    def partly_filled_last_buffer_test(self):
+        d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=3, buffers_per_file=2,
+                         dirpaths=self.dirpath, filepattern=NETCDF_PATTERN, mca_bins=64,
+                         first_file_n=1)
+        # the last file's second buffer holds 2 of its 3 pixels
+        eq_(len(d.files_indexed_by_pixel_step), 14)
+        self.assertTrue((d.spectrum(13, 9, 9) == generated_spectrum(13, 99, 64)).all())
+        self.assertRaises(IndexError, d.spectrum, 14, 9, 9)
+        d.preload()
+        eq_(len(d.module_data_cache), 14 * 100)
+        eq_(d.refresh(), [])
+
+    def rebin_dtype_test(self):
+        make = lambda dirpath, rebin, sparse=False: DetectorData(
+            shape=(10, 10), pixelsteps_per_buffer=3, buffers_per_file=2,
+            dirpaths=dirpath, filepattern=NETCDF_PATTERN, mca_bins=64,
+            first_file_n=1, rebin=rebin, sparse=sparse)
+        # rebinning shrinks the cube by the rebin factor
+        cube = make(self.dirpath, 2).cube()
+        eq_(cube.dtype, np.uint16)
+        eq_(cube.nbytes * 2, make(self.dirpath, 1).cube().nbytes)
+        # rebinned counts that overflow uint16 are decoded again as uint32
+        dirpath = tempfile.mkdtemp()
+        try:
+            spectrum = lambda pixel_step, element, bins: \
+                generated_spectrum(pixel_step, element, bins) * 1300
+            write_mode1_files(dirpath, pixel_steps=14, pixelsteps_per_buffer=3,
+                              buffers_per_file=2, bins=64, spectrum=spectrum)
+            expected = spectrum(13, 99, 64).reshape(32, 2).sum(axis=1, dtype=np.uint32)
+            self.assertTrue(expected.max() > 0xFFFF)
+            for sparse in [False, True]:
+                d = make(dirpath, 2, sparse)
+                eq_(d.spectrum(13, 9, 9).dtype, np.uint32)
+                self.assertTrue((d.spectrum(13, 9, 9) == expected).all())
+                d = make(dirpath, 2, sparse)
+                eq_(d.cube().dtype, np.uint32)
+                self.assertTrue((d.spectrum(13, 9, 9) == expected).all())
+        finally:
+            shutil.rmtree(dirpath)
+
+    def validate_pixel_numbering_test(self):
+        dirpath = tempfile.mkdtemp()
+        try:
+            write_mode1_files(dirpath, pixel_steps=10, pixelsteps_per_buffer=1,
+                              buffers_per_file=1, bins=64)
+            # a file of blocks numbered for the previous pixel_step, and two file
+            # groups swapped, in files of one pixel each
+            shutil.copy(os.path.join(dirpath, 'ioc53_5.nc'),
+                        os.path.join(dirpath, 'ioc53_6.nc'))
+            for ioc in ['ioc53', 'ioc54']:
+                paths = [os.path.join(dirpath, '{}_{}.nc'.format(ioc, file_n))
+                         for file_n in [8, 9]]
+                os.rename(paths[0], paths[0] + '.tmp')
+                os.rename(paths[1], paths[0])
+                os.rename(paths[0] + '.tmp', paths[1])
+            d = DetectorData(shape=(10, 10), pixelsteps_per_buffer=1, buffers_per_file=1,
+                             dirpaths=dirpath, filepattern=NETCDF_PATTERN, mca_bins=64,
+                             first_file_n=1)
+            validity = d.validate()
+            eq_(np.unique(np.argwhere(~validity)[:, 0]).tolist(), [5, 7, 8])
+            self.assertFalse(validity[5, :52].any())
+            self.assertTrue(validity[5, 52:].all())
+        finally:
+            shutil.rmtree(dirpath)
+
+    def cache_server_sparse_test(self):
+        server = CacheServer(os.path.join(self.dirpath, 'cache.sock'),
+                             root=os.path.join(self.dirpath, 'cubes'))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            make = lambda: DetectorData(
+                shape=(10, 10), pixelsteps_per_buffer=3, buffers_per_file=2,
+                dirpaths=self.dirpath, filepattern=NETCDF_PATTERN, mca_bins=64,
+                first_file_n=1, sparse=True, cache_socket=server.server_address)
+            first = make()
+            first.cube()
+            # the store is shared as its columns rather than as a dense cube
+            self.assertTrue(isinstance(first.spectra, SparseSpectra))
+            self.assertTrue(isinstance(first.spectra.data, np.memmap))
+            d = make()
+            self.assertTrue((d.cube().dense_step(13)[99] ==
+                             generated_spectrum(13, 99, 64)).all())
+            self.assertTrue(isinstance(d.spectra.data, np.memmap))
+            # only the buffer headers of the last files are peeked at by the index
+            self.assertEqual(d.io_stats()['bytes_read'], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def cube_budget_threads_test(self):
+        make = lambda cube_budget: DetectorData(
+            shape=(10, 10), pixelsteps_per_buffer=3, buffers_per_file=2,
+            dirpaths=self.dirpath, filepattern=NETCDF_PATTERN, mca_bins=64,
+            first_file_n=1, cube_budget=cube_budget)
+        budget = CubeBudget(int(1.5 * make(None).cube().nbytes))
+        expected = np.array([[generated_spectrum(pixel_step, element, 64)
+                              for element in range(100)] for pixel_step in range(14)])
+        failures = []
+        def use_cube(d):
+            # each build evicts the other scan's cube
+            for roi_low in range(40):
+                if not (d.roi_sums(roi_low, roi_low + 20) ==
+                        expected[:, :, roi_low:roi_low + 20].sum(axis=2)).all() or \
+                        not (d.window_sums(0, 14, roi_low, roi_low + 20) ==
+                             expected[:, :, roi_low:roi_low + 20].sum(axis=(0, 2))).all():
+                    failures.append(roi_low)
+        threads = [threading.Thread(target=use_cube, args=(make(budget),))
+                   for _ in range(2)]
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)     # switch threads often, interleaving the builds
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join(60)
+        finally:
+            sys.setcheckinterval(check_interval)
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(failures, [])
+
 if __name__ == '__main__':
     nose.run(defaultTest=__name__)
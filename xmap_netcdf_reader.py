@@ -7,14 +7,28 @@
 import numpy as np
 import os
 import re
-from utils import memoize
-from collections import defaultdict
+import json
+import struct
+import mmap
+import hashlib
+import shutil
+import threading
+import time
+import weakref
+import Queue
+from itertools import imap
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, OrderedDict
+from detector_geometry import CHANNELS_PER_MODULE, DetectorGeometry, get_geometry
+import cache_server
 
 
 # This module supports two netCDF file readers; scipy.io.netcdf_file and
 # pupynere.netcdf_file and prefers them in that order.
 # scipy.io.netcdf_file is based on pupynere.netcdf_file and is more likely to
 # be installed. scipy.io.netcdf_file and pupynere.netcdf_file are pure-Python modules.
+# Both parse every attribute and variable of every file, so files are opened with
+# ArrayDataFile below and these are only used for formats it doesn't read.
 NETCDF_READER = None
 uint16 = '>u2'
 uint32 = '>u4'
@@ -36,7 +50,37 @@ except:
 print NETCDF_READER
 
 
-CHANNELS_PER_MODULE = 4
+STATISTICS = ['realtime', 'livetime', 'triggers', 'output_events']
+
+
+# Buffer header defn for mapping mode 1: Full Spectrum Mapping.
+# Each module's data in a buffer is this header followed by pixelsteps_per_buffer
+# pixel blocks, each of 256 + 4 * mca_bins words.
+# See DXP-XMAP/xManager User Manual section 5.3.3.2
+buffer_header_mode1_dtype = [
+    ('tag0'             , uint16 ),  # 0x55AA
+    ('tag1'             , uint16 ),  # 0xAA55
+    ('header_size'      , uint16 ),  # Buffer header size=256
+    ('mapping_mode'     , uint16 ),  # Mapping mode=1=Full spectrum
+    ('run_number'       , uint16 ),
+    ('buffer_number'    , uint32 ),  # Sequential buffer number
+    ('buffer_id'        , uint16 ),  # 0=A, 1=B
+    ('pixels_in_buffer' , uint16 ),
+    ('starting_pixel'   , uint32 ),
+    ('module_serial_number', uint16 ),
+    ('ch0_detector_channel', uint16 ),
+    ('ch0_detector_element', uint16 ),
+    ('ch1_detector_channel', uint16 ),
+    ('ch1_detector_element', uint16 ),
+    ('ch2_detector_channel', uint16 ),
+    ('ch2_detector_element', uint16 ),
+    ('ch3_detector_channel', uint16 ),
+    ('ch3_detector_element', uint16 ),
+
+    ('reserved1'        , uint16, 255-20+1 ),
+]
+BUFFER_TAGS = (0x55AA, 0xAA55)
+PIXEL_TAGS = (0x33CC, 0xCC33)
 
 
 # Pixel header defn for mapping mode 1: Full Spectrum Mapping.
@@ -117,21 +161,1049 @@ def show_header_content(header):
         print "{}: {}: {}".format(t, type(item), item)
 
 
+# Sidecar cube files hold decoded arrays as raw columns following a JSON header:
+# magic, uint32 header length, header, then each column at a page-aligned offset.
+SIDECAR_MAGIC = 'SAKCUBE1'
+SIDECAR_ALIGN = 4096
+
+
+def write_sidecar(path, columns, fingerprint):
+    """Write arrays to a sidecar cube file. The file is written under a temporary name
+    and then renamed, so readers never see a partial file.
+
+    Keyword arguments:
+    path - sidecar file path
+    columns - dict of ndarrays keyed by column name
+    fingerprint - string identifying the source data; see read_sidecar()
+
+    """
+    names = sorted(columns)
+    header = {'fingerprint': fingerprint, 'columns': []}
+    offset = 0
+    for name in names:
+        header['columns'].append({'name': name, 'dtype': columns[name].dtype.str,
+                                  'shape': columns[name].shape, 'offset': offset})
+        offset += _sidecar_aligned(columns[name].nbytes)
+    header_json = json.dumps(header)
+    data_start = _sidecar_aligned(len(SIDECAR_MAGIC) + 4 + len(header_json))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SIDECAR_MAGIC)
+        f.write(struct.pack('<I', len(header_json)))
+        f.write(header_json)
+        for name, column in zip(names, header['columns']):
+            f.seek(data_start + column['offset'])
+            np.ascontiguousarray(columns[name]).tofile(f)
+    if os.path.exists(path):
+        os.remove(path)         # rename won't replace an existing file on Windows
+    os.rename(tmp_path, path)
+
+
+def _sidecar_aligned(offset):
+    """Round offset up to the next multiple of SIDECAR_ALIGN."""
+    return -(-offset // SIDECAR_ALIGN) * SIDECAR_ALIGN
+
+
+def read_sidecar(path, fingerprint):
+    """Map the arrays in a sidecar cube file read-only, without reading them.
+
+    Keyword arguments:
+    path - sidecar file path
+    fingerprint - string identifying the source data. If it differs from the one the
+                  sidecar was written with, the sidecar is stale and is ignored.
+
+    Returns:
+    A dict of read-only np.memmap arrays keyed by column name, or None if the sidecar
+    is missing, unreadable or stale.
+
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(SIDECAR_MAGIC)) != SIDECAR_MAGIC:
+                return None
+            header_length, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_length))
+    except (IOError, ValueError, struct.error):
+        return None
+    if header['fingerprint'] != fingerprint:
+        return None
+
+    data_start = _sidecar_aligned(len(SIDECAR_MAGIC) + 4 + header_length)
+    columns = {}
+    for column in header['columns']:
+        shape = tuple(column['shape'])
+        if 0 in shape:
+            columns[column['name']] = np.zeros(shape, dtype=column['dtype'])
+        else:
+            columns[column['name']] = np.memmap(
+                path, dtype=column['dtype'], mode='r', shape=shape,
+                offset=data_start + column['offset'])
+    return columns
+
+
+# Exported cubes are a directory of plain .npy files, one per array, described by a
+# JSON file, so that other programs can np.load(..., mmap_mode='r') them without this
+# module. See DetectorData.export().
+EXPORT_DESCRIPTOR = 'cube.json'
+EXPORT_FORMAT = 'sakura-cube-export'
+EXPORT_VERSION = 1
+
+
+def write_export(directory, arrays, descriptor):
+    """Write arrays as .npy files and a JSON descriptor of them into directory. Each
+    file is written under a temporary name and then renamed, the descriptor last, so
+    readers that open the descriptor first never see partial files.
+
+    Keyword arguments:
+    directory - output directory, created if necessary
+    arrays - dict keyed by array name of ndarrays, or of SparseSpectra stores, which
+             are written as dense (steps, elements, bins) arrays one pixel_step at a
+             time
+    descriptor - dict of items describing the arrays, e.g. the detector shape, to
+             which 'format', 'version' and 'arrays' are added
+
+    Returns:
+    The path of the descriptor
+
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    descriptor = dict(descriptor, format=EXPORT_FORMAT, version=EXPORT_VERSION,
+                      arrays={})
+    for name in sorted(arrays):
+        array = arrays[name]
+        filename = name + '.npy'
+        path = os.path.join(directory, filename)
+        tmp_path = path + '.tmp'
+        if isinstance(array, SparseSpectra) and len(array):
+            out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=array.dtype,
+                                            shape=array.shape)
+            for pixel_step in range(len(array)):
+                out[pixel_step] = array.dense_step(pixel_step)
+            out.flush()
+            del out
+        else:
+            if isinstance(array, SparseSpectra):
+                array = np.zeros(array.shape, dtype=array.dtype)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+        if os.path.exists(path):
+            os.remove(path)     # rename won't replace an existing file on Windows
+        os.rename(tmp_path, path)
+        descriptor['arrays'][name] = {'file': filename, 'dtype': np.dtype(array.dtype).str,
+                                      'shape': list(array.shape)}
+    path = os.path.join(directory, EXPORT_DESCRIPTOR)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(descriptor, f, indent=1, separators=(',', ': '), sort_keys=True)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+    return path
+
+
+def read_export(directory, mmap_mode='r'):
+    """Load the arrays of a cube exported by DetectorData.export().
+
+    Keyword arguments:
+    directory - directory holding the descriptor and .npy files
+    mmap_mode - passed to np.load; by default the arrays are mapped read-only
+
+    Returns:
+    A tuple (descriptor, arrays), where arrays is a dict of the arrays keyed by name
+
+    """
+    with open(os.path.join(directory, EXPORT_DESCRIPTOR)) as f:
+        descriptor = json.load(f)
+    if descriptor.get('format') != EXPORT_FORMAT:
+        raise ValueError('{} is not a cube export'.format(directory))
+    arrays = {name: np.load(os.path.join(directory, item['file']), mmap_mode=mmap_mode)
+              for name, item in descriptor['arrays'].iteritems()}
+    return descriptor, arrays
+
+
+def _grow_steps(array, steps):
+    """Return a (steps, ...) array whose leading pixel_steps hold the data of array.
+    Growth is amortised: if array is a leading slice of a larger buffer, the returned
+    array is a longer slice of the same buffer; otherwise the data is copied into a new
+    buffer with room for at least twice as many pixel_steps.
+
+    """
+    base = array.base
+    if (type(base) is np.ndarray and base.shape[1:] == array.shape[1:] and
+            base.dtype == array.dtype and len(base) >= steps and
+            base.ctypes.data == array.ctypes.data and base.flags.c_contiguous):
+        return base[:steps]
+    buf = np.zeros((max(steps, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    buf[:len(array)] = array
+    return buf[:steps]
+
+
+class SparseSpectra(object):
+    """A (steps, elements, bins) spectrum store holding only the non-zero bins, for
+    spectra that are mostly empty outside the fluorescence and scatter peaks.
+    Each spectrum's non-zero bins are a run [starts, ends) of the flat indices (bin
+    numbers) and data (counts) arrays, so spectra can be added in any order, e.g.
+    one file at a time from several threads. Indexing with (pixel_step, element)
+    returns the dense spectrum and roi_sums() works on the compressed form.
+
+    """
+    def __init__(self, steps, elements, bins, dtype=np.uint16):
+        self.shape = (steps, elements, bins)
+        self.dtype = np.dtype(dtype)
+        self.starts = np.zeros((steps, elements), dtype=np.int64)
+        self.ends = np.zeros((steps, elements), dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.uint16)
+        self.data = np.zeros(0, dtype=self.dtype)
+        self._chunks = []    # (indices, data) added since the arrays were consolidated
+        self._size = 0       # no. of non-zero bins held, including the chunks
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_columns(cls, columns, bins):
+        """Return a store over starts, ends, indices and data arrays, e.g. mapped
+        from a sidecar file by read_sidecar().
+
+        """
+        steps, elements = columns['starts'].shape
+        spectra = cls(steps, elements, bins, columns['data'].dtype)
+        for name in ['starts', 'ends', 'indices', 'data']:
+            setattr(spectra, name, columns[name])
+        spectra._size = len(spectra.data)
+        return spectra
+
+    def columns(self):
+        """Return the arrays holding the store, keyed by name."""
+        self._consolidate()
+        return {'starts': self.starts, 'ends': self.ends,
+                'indices': self.indices, 'data': self.data}
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        self._consolidate()
+        return sum(a.nbytes for a in [self.starts, self.ends, self.indices, self.data])
+
+    def __setitem__(self, where, values):
+        """Store dense spectra.
+
+        Keyword arguments:
+        where - (pixel_steps, elements) index pair as for a (steps, elements, bins)
+                array, where pixel_steps is a 1-D array and elements a slice, or
+                pixel_steps is an (n, 1) array and elements a 1-D array
+        values - (n, elements, bins) array of the dense spectra
+
+        """
+        pixel_steps, elements = where
+        if isinstance(elements, slice):
+            elements = np.arange(*elements.indices(self.shape[1]))
+        pixel_steps = np.asarray(pixel_steps).reshape(-1, 1)
+        values = values.reshape(-1, self.shape[2])
+        rows, bins = np.nonzero(values)
+        counts = np.bincount(rows, minlength=len(values))
+        with self.lock:
+            offset = self._size
+            self._size += len(rows)
+            self._chunks.append((bins.astype(np.uint16), values[rows, bins].astype(self.dtype)))
+        ends = offset + np.cumsum(counts).reshape(len(pixel_steps), len(elements))
+        self.starts[pixel_steps, elements] = ends - counts.reshape(ends.shape)
+        self.ends[pixel_steps, elements] = ends
+
+    def _consolidate(self):
+        with self.lock:
+            if self._chunks:
+                chunk_indices, chunk_data = zip(*self._chunks)
+                self.indices = np.concatenate((self.indices,) + chunk_indices)
+                self.data = np.concatenate((self.data,) + chunk_data)
+                self._chunks = []
+
+    def __getitem__(self, key):
+        """Return the dense spectrum of key = (pixel_step, element)."""
+        self._consolidate()
+        start, end = self.starts[key], self.ends[key]
+        spectrum = np.zeros(self.shape[2], dtype=self.dtype)
+        spectrum[self.indices[start:end]] = self.data[start:end]
+        return spectrum
+
+    def dense_step(self, pixel_step):
+        """Return the dense (elements, bins) spectra of pixel_step."""
+        self._consolidate()
+        starts, ends = self.starts[pixel_step], self.ends[pixel_step]
+        counts = ends - starts
+        # position in indices and data of every non-zero bin of the step
+        positions = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts),
+                                                        counts)
+        spectra = np.zeros(self.shape[1:], dtype=self.dtype)
+        spectra[np.repeat(np.arange(self.shape[1]), counts),
+                self.indices[positions]] = self.data[positions]
+        return spectra
+
+    def resize(self, steps):
+        """Grow or truncate the store to steps pixel_steps. New pixel_steps hold empty
+        spectra.
+
+        """
+        self.starts = _grow_steps(self.starts, steps)
+        self.ends = _grow_steps(self.ends, steps)
+        self.shape = (steps,) + self.shape[1:]
+
+    def resized(self, steps, dtype=None):
+        """Return a copy of the store grown or truncated to steps pixel_steps, leaving
+        this one unchanged for its readers. The non-zero bins held are shared unless
+        they are converted to another dtype.
+
+        """
+        self._consolidate()
+        dtype = np.dtype(dtype or self.dtype)
+        spectra = SparseSpectra(steps, self.shape[1], self.shape[2], dtype)
+        spectra.starts = _grow_steps(self.starts, steps)
+        spectra.ends = _grow_steps(self.ends, steps)
+        spectra.indices = self.indices
+        spectra.data = self.data.astype(dtype, copy=False)
+        spectra._size = len(self.data)
+        return spectra
+
+    def roi_sums(self, roi_low, roi_high):
+        """Return the sums of bins [roi_low, roi_high) of all spectra as a
+        (steps, elements) uint32 array, in one pass over the non-zero bins.
+
+        """
+        self._consolidate()
+        in_roi = (self.indices >= roi_low) & (self.indices < roi_high)
+        cumulative = np.zeros(len(self.data) + 1, dtype=np.uint64)
+        np.cumsum(np.where(in_roi, self.data, 0), dtype=np.uint64, out=cumulative[1:])
+        return (cumulative[self.ends] - cumulative[self.starts]).astype(np.uint32)
+
+
+def decode_mode1_statistics(pixel_blocks):
+    """Decode the channel statistics of any number of mapping mode 1 pixel blocks in one
+    vectorized pass. Each uint32 statistic is stored as a pair of 16-bit words, low word
+    first, in words 32-63 of the pixel header (see
+    pixel_header_mode1_static_fixedbins_dtype).
+
+    Keyword arguments:
+    pixel_blocks - uint16 array of shape (..., modules, words) with words >= 64, holding
+                   the pixel blocks of consecutive modules
+
+    Returns:
+    A dict keyed by metric (see STATISTICS) of uint32 arrays of shape
+    (..., modules * CHANNELS_PER_MODULE), i.e. ordered by detector element
+
+    """
+    words = pixel_blocks[..., 32:64].astype(np.uint32)
+    words = words.reshape(words.shape[:-1] + (CHANNELS_PER_MODULE, len(STATISTICS), 2))
+    values = (words[..., 1] << 16) | words[..., 0]   # (..., modules, channels, metrics)
+    values = values.reshape(values.shape[:-3] + (-1, len(STATISTICS)))
+    return {metric: values[..., i] for i, metric in enumerate(STATISTICS)}
+
+
+# checks made by validate_mode1_pixel_blocks(), in the order they are reported
+PIXEL_BLOCK_CHECKS = ['tags', 'header', 'pixel_number', 'block_size', 'channel_size']
+
+
+def pixel_number_offset(pixel_blocks, pixel_steps):
+    """Return the most common offset of the pixel_number of mapping mode 1 pixel blocks
+    from their pixel_step, i.e. the number the XMAP gave pixel_step 0, or None if no
+    block is tagged as a pixel block.
+
+    Keyword arguments:
+    pixel_blocks - uint16 array of shape (steps, modules, words) with words >= 12
+    pixel_steps - (steps,) pixel_step of each row of pixel_blocks
+
+    """
+    words = pixel_blocks[..., :6].astype(np.uint32)
+    tagged = (words[..., 0] == PIXEL_TAGS[0]) & (words[..., 1] == PIXEL_TAGS[1])
+    offsets = _pixel_number_offsets(words, pixel_steps)[tagged]
+    if not len(offsets):
+        return None
+    values, counts = np.unique(offsets, return_counts=True)
+    return int(values[np.argmax(counts)])
+
+
+def _pixel_number_offsets(words, pixel_steps):
+    return (((words[..., 5] << 16) | words[..., 4]).astype(np.int64) -
+            np.asarray(pixel_steps, dtype=np.int64)[:, np.newaxis])
+
+
+def validate_mode1_pixel_blocks(pixel_blocks, mca_bins, pixel_steps, offset=None):
+    """Check the pixel headers of any number of mapping mode 1 pixel blocks in one
+    vectorized pass (see pixel_header_mode1_static_fixedbins_dtype).
+    The pixel_number of a block must be the given offset from its pixel_step, so
+    blocks that are out of order, repeated or skipped are found whatever the XMAP
+    numbered the first pixel of the scan. Without an offset, that of most of the
+    blocks is expected, which can't find blocks numbered for the wrong pixel_steps
+    when they are all from one buffer.
+
+    Keyword arguments:
+    pixel_blocks - uint16 array of shape (steps, modules, words) with words >= 12
+    mca_bins - no. of bins in MCA modules
+    pixel_steps - (steps,) pixel_step of each row of pixel_blocks
+    offset - pixel_number of pixel_step 0, see pixel_number_offset(), or None
+
+    Returns:
+    A dict keyed by check (see PIXEL_BLOCK_CHECKS) of bool arrays, True where a block
+    failed the check:
+    'tags' - tag0/tag1 are not 0x33CC/0xCC33, i.e. the block is missing or corrupt
+    'header' - header_size is not 256 or mapping_mode is not 1
+    'pixel_number' - pixel_number is out of order
+    'block_size' - total_pixel_block_size is not 256 + 4 * mca_bins
+    'channel_size' - a ch*_size is not mca_bins
+    All are of shape (steps, modules) except channel_size, (steps, modules, channels).
+    The dict also holds 'valid', a (steps, modules * CHANNELS_PER_MODULE) array,
+    i.e. ordered by detector element, True where an element's data passed every
+    check.
+
+    """
+    words = pixel_blocks[..., :12].astype(np.uint32)
+    problems = {
+        'tags': (words[..., 0] != PIXEL_TAGS[0]) | (words[..., 1] != PIXEL_TAGS[1]),
+        'header': (words[..., 2] != 256) | (words[..., 3] != 1),
+        'block_size': ((words[..., 7] << 16) | words[..., 6]) != 256 + 4 * mca_bins,
+        'channel_size': words[..., 8:12] != mca_bins,
+    }
+    if offset is None:
+        offset = pixel_number_offset(pixel_blocks, pixel_steps)
+    if offset is not None:
+        problems['pixel_number'] = _pixel_number_offsets(words, pixel_steps) != offset
+    else:
+        problems['pixel_number'] = np.zeros(problems['tags'].shape, dtype=bool)
+
+    bad_blocks = (problems['tags'] | problems['header'] | problems['pixel_number'] |
+                  problems['block_size'])
+    valid = ~(bad_blocks[..., np.newaxis] | problems['channel_size'])
+    problems['valid'] = valid.reshape(valid.shape[:-2] + (-1,))
+    return problems
+
+
 class DataCache(dict):
     """The module_data_cache implements a lazy read system for reading all data from
     specific files. Attempting to read data for a (step, row, col) triple looks in
     module_data_cache. A cache hit causes data to be read from the module_data and
     channel specified:
     {(step, row, col): [module_data object reference, 0-3], ... }
+    Misses and bulk updates are serialised by a lock so that the cache can be filled
+    from several threads.
+    If max_bytes is set, entries are added in groups, e.g. all entries read from one
+    netCDF file group, and whole groups are evicted, least recently used first, while
+    the data held exceeds max_bytes. Evicted entries are read again on their next
+    access. self.nbytes is the no. of bytes of data currently held.
 
     """
-    def __init__(self, fn):
+    def __init__(self, fn, max_bytes=None):
         self.fn = fn
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.nbytes = 0
+        self.groups = OrderedDict()     # {group: set of keys}, least recently used first
+        self.entry_sizes = {}           # {key: (group, bytes)}
+        # no. of __getitem__ calls and of those that had to read a file
+        self.lookups = 0
+        self.misses = 0
 
     def __missing__(self, key):
-        lookup = self.fn(key)
-        self[key] = lookup
-        return lookup
+        with self.lock:
+            if dict.__contains__(self, key):
+                # filled by another thread while we waited for the lock
+                return dict.__getitem__(self, key)
+            self.misses += 1
+            lookup = self.fn(key)
+            if not dict.__contains__(self, key):
+                self.update_entries({key: lookup})
+            return lookup
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        value = dict.__getitem__(self, key)
+        if self.max_bytes is not None:
+            with self.lock:
+                # mark the entry's group as most recently used
+                group, _ = self.entry_sizes.get(key, (None, 0))
+                if group in self.groups:
+                    self.groups[group] = self.groups.pop(group)
+        return value
+
+    def update_entries(self, entries, group=None):
+        """Add a dict of entries under the lock, evicting least recently used groups if
+        the cache is over budget. The group being added is never evicted.
+
+        Arguments:
+        entries - dict of {key: [data, channel]} entries
+        group - hashable id of the group the entries belong to
+
+        """
+        # The entries for the channels of a module share one data array
+        shares = defaultdict(int)
+        for data, _ in entries.itervalues():
+            shares[id(data)] += 1
+
+        with self.lock:
+            self.remove_entries(entries)
+            keys = self.groups.pop(group, set())
+            for key, entry in entries.iteritems():
+                size = entry[0].nbytes / shares[id(entry[0])]
+                dict.__setitem__(self, key, entry)
+                self.entry_sizes[key] = (group, size)
+                self.nbytes += size
+                keys.add(key)
+            self.groups[group] = keys
+
+            if self.max_bytes is not None:
+                while self.nbytes > self.max_bytes and len(self.groups) > 1:
+                    oldest = next(iter(self.groups))
+                    if oldest == group:
+                        break
+                    self.remove_entries(self.groups.pop(oldest))
+
+    def remove_entries(self, keys):
+        """Remove any entries for keys that are present."""
+        with self.lock:
+            for key in keys:
+                if not dict.__contains__(self, key):
+                    continue
+                dict.__delitem__(self, key)
+                group, size = self.entry_sizes.pop(key)
+                self.nbytes -= size
+                if group in self.groups:
+                    self.groups[group].discard(key)
+                    if not self.groups[group]:
+                        del self.groups[group]
+
+
+class CubeBudget(object):
+    """A byte budget shared by the spectrum cubes of several DetectorData instances,
+    e.g. of all the scans open in one session. module_data_cache budgets only the
+    per-file entries, which aren't used once a cube is built. Whenever a cube or an
+    array derived from it is built, the least recently used other instances release
+    their cubes (see DetectorData.release_cube()) while the total held exceeds
+    max_bytes; a released cube is built again, or mapped again from its sidecar, on
+    its next use. Arrays mapped from files aren't counted, as their pages can be
+    reclaimed by the OS.
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        # {id(detector_data): weakref to it}, least recently used first
+        self.holders = OrderedDict()
+
+    def use(self, detector_data, resized=False):
+        """Mark detector_data's cube as the most recently used and, if it has been
+        resized, release other cubes until the total is within budget.
+
+        """
+        key = id(detector_data)
+        with self.lock:
+            if not resized and next(reversed(self.holders), None) == key:
+                return
+            self.holders.pop(key, None)
+            self.holders[key] = weakref.ref(detector_data)
+            if not resized:
+                return
+            released = self._evict(key)
+        # outside the lock, as releasing a cube takes the instance's own lock
+        for holder in released:
+            holder.release_cube()
+
+    def _evict(self, keep):
+        """Return the least recently used instances, other than that of keep, whose
+        cubes must be released to bring the total within budget.
+
+        """
+        total = self.nbytes()
+        released = []
+        for key in list(self.holders):
+            if total <= self.max_bytes:
+                break
+            holder = self.holders[key]()
+            if key == keep or holder is None:
+                continue
+            total -= holder.cube_nbytes()
+            released.append(holder)
+            del self.holders[key]
+        return released
+
+    def nbytes(self):
+        """Return the no. of bytes held by the cubes of the instances using the budget."""
+        with self.lock:
+            for key, ref in self.holders.items():
+                if ref() is None:
+                    del self.holders[key]
+            return sum(ref().cube_nbytes() for ref in self.holders.itervalues())
+
+
+# A minimal reader for the netCDF-3 classic and 64-bit offset formats, which is all
+# the XMAP IOC writes. Unlike the general purpose readers above it doesn't build
+# objects for every attribute and variable in the header; it only locates the
+# array_data variable and returns it as an ndarray over the file's bytes.
+# See the netCDF Classic Format Specification.
+NC_DIMENSION = 0x0A
+NC_VARIABLE = 0x0B
+NC_ATTRIBUTE = 0x0C
+NC_STREAMING = 0xFFFFFFFF
+NC_TYPES = {1: '>i1', 2: 'S1', 3: '>i2', 4: '>i4', 5: '>f4', 6: '>f8'}
+
+
+class NetCDFHeaderError(ValueError):
+    """A netCDF classic header that is truncated, e.g. still being written, or
+    garbled.
+
+    """
+
+
+class _HeaderCursor(object):
+    """Reads the big-endian ints and padded names of a netCDF classic header. Reading
+    past the end of the data raises NetCDFHeaderError.
+
+    """
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, fmt):
+        try:
+            values = struct.unpack_from(fmt, self.data, self.offset)
+        except struct.error:
+            raise NetCDFHeaderError('Truncated netCDF header')
+        self.offset += struct.calcsize(fmt)
+        return values if len(values) > 1 else values[0]
+
+    def count(self):
+        """Read the length of a list, each item of which takes at least 4 bytes."""
+        count = self.read('>i')
+        if not 0 <= count <= (len(self.data) - self.offset) // 4:
+            raise NetCDFHeaderError('Truncated netCDF header')
+        return count
+
+    def skip(self, size):
+        self.offset += -(-size // 4) * 4     # values are padded to 4 bytes
+
+    def name(self):
+        size = self.read('>i')
+        if size < 0 or self.offset + size > len(self.data):
+            raise NetCDFHeaderError('Truncated netCDF header')
+        name = self.data[self.offset: self.offset + size]
+        self.skip(size)
+        return name
+
+    def attributes(self):
+        tag, count = self.read('>i'), self.count()
+        if tag not in (0, NC_ATTRIBUTE):
+            raise NetCDFHeaderError('Invalid netCDF attribute list')
+        for _ in range(count):
+            self.name()
+            nc_type, nelems = self.read('>ii')
+            self.skip(nelems * _nc_dtype(nc_type).itemsize)
+
+
+def _nc_dtype(nc_type):
+    try:
+        return np.dtype(NC_TYPES[nc_type])
+    except KeyError:
+        raise NetCDFHeaderError('Invalid netCDF type {}'.format(nc_type))
+
+
+def parse_netcdf_header(data):
+    """Parse a netCDF classic or 64-bit offset header.
+
+    Keyword arguments:
+    data - string or buffer starting with the file header
+
+    Raises:
+    ValueError if data isn't a netCDF classic header, or NetCDFHeaderError if the
+    header is truncated or garbled
+
+    Returns:
+    A tuple (numrecs, recsize, variables):
+    numrecs - no. of records, or NC_STREAMING if it wasn't written
+    recsize - no. of bytes per record of all record variables
+    variables - dict keyed by name of (shape, dtype, begin, is_record) where the
+                length of the record dimension in shape is None
+
+    """
+    magic = data[:4]
+    if len(magic) < 4 or magic[:3] != 'CDF' or magic[3] not in '\x01\x02':
+        raise ValueError('Not a netCDF classic format file')
+    offset_format = '>i' if magic[3] == '\x01' else '>q'
+    cursor = _HeaderCursor(data)
+    cursor.offset = 4
+    numrecs = cursor.read('>I')
+
+    tag, count = cursor.read('>i'), cursor.count()
+    if tag not in (0, NC_DIMENSION):
+        raise NetCDFHeaderError('Invalid netCDF dimension list')
+    dimensions = []
+    for _ in range(count):
+        cursor.name()
+        dimensions.append(cursor.read('>i') or None)    # 0 is the record dimension
+
+    cursor.attributes()
+
+    tag, count = cursor.read('>i'), cursor.count()
+    if tag not in (0, NC_VARIABLE):
+        raise NetCDFHeaderError('Invalid netCDF variable list')
+    variables = {}
+    record_sizes = []
+    for _ in range(count):
+        name = cursor.name()
+        ndims = cursor.count()
+        dimids = [cursor.read('>i') for _ in range(ndims)]
+        if any(not 0 <= dimid < len(dimensions) for dimid in dimids):
+            raise NetCDFHeaderError('Invalid netCDF dimension id in {}'.format(name))
+        shape = tuple(dimensions[dimid] for dimid in dimids)
+        cursor.attributes()
+        nc_type, vsize = cursor.read('>ii')
+        begin = cursor.read(offset_format)
+        dtype = _nc_dtype(nc_type)
+        is_record = bool(shape) and shape[0] is None
+        if is_record:
+            record_sizes.append((vsize, int(np.prod(shape[1:])) * dtype.itemsize))
+        variables[name] = (shape, dtype, begin, is_record)
+
+    if len(record_sizes) == 1:
+        recsize = record_sizes[0][1]    # a lone record variable isn't padded
+    else:
+        recsize = sum(vsize for vsize, _ in record_sizes)
+    return numrecs, recsize, variables
+
+
+class ArrayDataLayout(object):
+    """The location of array_data in a netCDF file, which is the same in every file
+    an IOC writes during a scan. It is parsed from one file's header and reused for
+    the others after checking that they have the same size and leading header bytes.
+
+    """
+    # magic and numrecs
+    HEADER_CHECK_SIZE = 8
+
+    def __init__(self, data, path=''):
+        """Parse the header at the start of data, locating array_data.
+
+        Keyword arguments:
+        data - string or buffer holding the whole file
+        path - file path, used in error messages
+
+        """
+        numrecs, recsize, variables = parse_netcdf_header(data)
+        if 'array_data' not in variables:
+            raise ValueError('No array_data variable in {}'.format(path))
+        shape, dtype, begin, is_record = variables['array_data']
+
+        strides = [dtype.itemsize]
+        for length in reversed(shape[1:]):
+            strides.insert(0, strides[0] * length)
+        if is_record:
+            strides[0] = recsize
+            size = int(np.prod(shape[1:])) * dtype.itemsize
+            available = 0
+            if len(data) >= begin + size:
+                available = (len(data) - begin - size) // recsize + 1
+            if numrecs == NC_STREAMING:
+                numrecs = available
+            elif numrecs > available:
+                raise IOError('{} has {} of {} records'.format(path, available, numrecs))
+            shape = (numrecs,) + shape[1:]
+        elif len(data) < begin + int(np.prod(shape)) * dtype.itemsize:
+            raise IOError('{} is truncated'.format(path))
+
+        self.shape = shape
+        self.dtype = dtype
+        self.begin = begin
+        self.strides = tuple(strides)
+        self.file_size = len(data)
+        self.header = data[:self.HEADER_CHECK_SIZE]
+
+    def matches(self, data):
+        """Return True if data, the bytes of another file, has this layout."""
+        return len(data) == self.file_size and \
+            data[:self.HEADER_CHECK_SIZE] == self.header
+
+    def view(self, data):
+        """Return array_data as an ndarray over data."""
+        return np.ndarray(self.shape, self.dtype, buffer=data, offset=self.begin,
+                          strides=self.strides)
+
+
+class ArrayDataFile(object):
+    """A netCDF file opened for its array_data variable only. It provides the
+    subset of the netcdf_file interface used here: variables['array_data'] and
+    close().
+
+    """
+    def __init__(self, path, use_mmap=False, layout=None):
+        """Locate array_data in the file at path and view it as an ndarray.
+
+        Keyword arguments:
+        path - netCDF file path
+        use_mmap - if True, memory-map the file rather than reading it; array_data
+                   is then a read-only view into the mapping
+        layout - ArrayDataLayout of a similar file, used instead of parsing the
+                 header if the file matches it. self.layout is the layout used.
+
+        self.open_time and self.parse_time are the seconds taken to open (and read)
+        the file and to locate array_data, and self.bytes_read the no. of bytes read,
+        which is 0 for a mapped file until its pages are touched.
+
+        """
+        start = time.time()
+        with open(path, 'rb') as f:
+            if use_mmap:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.bytes_read = 0
+            else:
+                data = f.read()
+                self.bytes_read = len(data)
+        opened = time.time()
+        if layout is None or not layout.matches(data):
+            layout = ArrayDataLayout(data, path)
+        self.layout = layout
+        self.variables = {'array_data': layout.view(data)}
+        self.open_time = opened - start
+        self.parse_time = time.time() - opened
+
+    def close(self):
+        """Release this file's reference to its data. A mapping stays valid until
+        the last view into it is released.
+
+        """
+        self.variables = {}
+
+
+def open_netcdf(path, use_mmap=False, layout=None):
+    """Return an open netCDF file for path, using ArrayDataFile for netCDF classic
+    files and netcdf_file for any other format it can read.
+
+    Raises:
+    ValueError if neither can read the file, e.g. one whose header is still being
+    written
+
+    """
+    try:
+        return ArrayDataFile(path, use_mmap, layout)
+    except NetCDFHeaderError:
+        # netcdf_file reads the same format, and can exhaust memory on a garbled header
+        raise
+    except ValueError as exc:
+        if NETCDF_READER is None:
+            raise
+        parse_error = exc
+    try:
+        f = netcdf_file(path, 'r', mmap=use_mmap)
+    except Exception:
+        # netcdf_file fails with assorted errors on files it can't read
+        raise parse_error
+    if 'array_data' not in f.variables:
+        f.close()
+        raise parse_error
+    return f
+
+
+def _touch_pages(entries):
+    """Read a byte of every page of the data of module_data_cache entries, so that
+    the pages of a mapped file are read from disk now rather than on first access.
+
+    """
+    seen = set()
+    for data, _ in entries.itervalues():
+        if id(data) not in seen:
+            seen.add(id(data))
+            data.view(np.uint8)[::mmap.PAGESIZE].sum()
+
+
+class MappedFilePool(object):
+    """A bounded pool of netCDF files held open with their data memory-mapped, so that
+    cached pixel data can remain read-only views into the mapped files rather than
+    copies. When the pool is full, the least recently opened file is closed to make
+    room, calling on_close(path) first so that the owner can drop any views into it.
+    Files are opened with open_file(path), which defaults to open_netcdf with use_mmap.
+
+    """
+    def __init__(self, max_open, on_close=None, open_file=None):
+        self.max_open = max_open
+        self.on_close = on_close
+        self.open_file = open_file or (lambda path: open_netcdf(path, use_mmap=True))
+        self.files = OrderedDict()
+        self.lock = threading.RLock()
+
+    def open(self, path):
+        """Return an open mmap-backed netCDF file handle for path, opening it if
+        it isn't already in the pool.
+
+        """
+        with self.lock:
+            if path in self.files:
+                f = self.files.pop(path)
+            else:
+                while len(self.files) >= self.max_open:
+                    self.close(next(iter(self.files)))
+                f = self.open_file(path)
+            self.files[path] = f      # (re)insert as most recently used
+            return f
+
+    def close(self, path):
+        """Close the file path if it is in the pool."""
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is None:
+                return
+            if self.on_close is not None:
+                self.on_close(path)
+            f.close()
+
+    def close_all(self):
+        for path in list(self.files):
+            self.close(path)
+
+
+class IOStats(object):
+    """Thread-safe counters of the file I/O and decoding done by a DetectorData, per
+    file and in total. Times are summed over threads, so with several workers they
+    can exceed the elapsed time.
+    Counters of each file, see FIELDS:
+    opens - no. of times the file was opened
+    bytes_read - no. of bytes read from the file, i.e. the whole file when it is
+                 read into memory, or just the data copied out of a mapped file
+    open_time - seconds spent opening and reading or mapping the file
+    parse_time - seconds spent parsing the netCDF header to locate array_data
+    read_time - seconds spent copying pixel data out of the file
+    decode_time - seconds spent decoding pixel blocks into the cube or statistics
+    cache_misses - no. of module_data_cache misses that read the file
+
+    """
+    FIELDS = ['opens', 'bytes_read', 'open_time', 'parse_time', 'read_time',
+              'decode_time', 'cache_misses']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+
+    def add(self, filename, **counts):
+        """Add counts, keyed by field, to the counters of filename."""
+        with self.lock:
+            if filename not in self.files:
+                self.files[filename] = dict.fromkeys(self.FIELDS, 0)
+            file_counts = self.files[filename]
+            for field, count in counts.iteritems():
+                file_counts[field] += count
+
+    def totals(self):
+        """Return the sum of each field over all files."""
+        with self.lock:
+            return {field: sum(counts[field] for counts in self.files.itervalues())
+                    for field in self.FIELDS}
+
+    def reset(self):
+        with self.lock:
+            self.files = {}
+
+
+def format_io_totals(totals, elapsed=None):
+    """Return a one-line summary of IOStats.totals(), or the difference of two."""
+    summary = '{} opens, {:.1f} MB read, open {:.2f}s, parse {:.2f}s, read {:.2f}s, ' \
+              'decode {:.2f}s'.format(totals['opens'], totals['bytes_read'] / 1e6,
+                                      totals['open_time'], totals['parse_time'],
+                                      totals['read_time'], totals['decode_time'])
+    if elapsed:
+        summary += ' in {:.2f}s ({:.1f} MB/s)'.format(
+            elapsed, totals['bytes_read'] / 1e6 / elapsed)
+    return summary
+
+
+# marks the end of the items passed between the stages of staged_imap()
+_END_OF_ITEMS = object()
+
+
+def staged_imap(stages, iterable, queue_size=4):
+    """Like imap() with a chain of functions, but each function runs on its own
+    threads, connected to the next function's threads by a bounded queue, so that the
+    stages overlap, e.g. one file is decoded while the next ones are read. Results
+    are yielded in the order of iterable, so the caller can process the first items
+    while later ones are still in the pipeline.
+
+    Keyword arguments:
+    stages - sequence of (function, threads) pairs. Each function is called with the
+             result of the previous one, the first with an item of iterable.
+    iterable - items to process
+    queue_size - max no. of items waiting between two stages
+
+    Returns:
+    An iterator of (item, result, exc) tuples, where exc is the exception raised by
+    the first stage to fail for item, and result is then None. Closing the iterator
+    early stops the stages once the items in progress are finished.
+
+    """
+    stop = threading.Event()
+    # bounds the items taken from iterable but not yet yielded, so that a slow item
+    # can't leave an unbounded no. of later results waiting to be yielded
+    in_flight = threading.Semaphore(queue_size * len(stages) +
+                                    sum(threads for _, threads in stages))
+    queues = [Queue.Queue(queue_size) for _ in stages] + [Queue.Queue()]
+    errors = []
+
+    def end_stage(stage_ix):
+        """Tell the threads of stage stage_ix that no more items are coming."""
+        threads = stages[stage_ix][1] if stage_ix < len(stages) else 1
+        for _ in range(threads):
+            queues[stage_ix].put(_END_OF_ITEMS)
+
+    def feed():
+        try:
+            for i, item in enumerate(iterable):
+                in_flight.acquire()
+                if stop.is_set():
+                    break
+                queues[0].put((i, item, item, None))
+        except Exception as exc:
+            errors.append(exc)
+        finally:
+            end_stage(0)
+
+    def work(stage_ix, running):
+        function = stages[stage_ix][0]
+        while True:
+            task = queues[stage_ix].get()
+            if task is _END_OF_ITEMS:
+                with running['lock']:
+                    running['threads'] -= 1
+                    if not running['threads']:
+                        end_stage(stage_ix + 1)
+                return
+            i, item, value, exc = task
+            if exc is None and not stop.is_set():
+                try:
+                    value = function(value)
+                except Exception as e:
+                    value, exc = None, e
+            queues[stage_ix + 1].put((i, item, value, exc))
+
+    threads = [threading.Thread(target=feed, name='staged_imap.feed')]
+    for stage_ix, (_, stage_threads) in enumerate(stages):
+        running = {'lock': threading.Lock(), 'threads': stage_threads}
+        threads.extend(threading.Thread(target=work, args=(stage_ix, running),
+                                        name='staged_imap.stage{}'.format(stage_ix))
+                       for _ in range(stage_threads))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        pending = {}
+        next_i = 0
+        while True:
+            task = queues[-1].get()
+            if task is _END_OF_ITEMS:
+                break
+            pending[task[0]] = task[1:]
+            while next_i in pending:
+                yield pending.pop(next_i)
+                in_flight.release()
+                next_i += 1
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+        in_flight.release()     # wake the feeder if it is waiting
 
 
 class DetectorData(object):
@@ -139,13 +1211,20 @@ class DetectorData(object):
     multi-element detector.
     """
     def __init__(self, shape, pixelsteps_per_buffer, buffers_per_file,
-                 dirpaths, filepattern, mca_bins=2048, first_file_n=1):
+                 dirpaths, filepattern, mca_bins=2048, first_file_n=1,
+                 use_mmap=False, max_open_files=64, cache_bytes=None, rebin=1,
+                 step_window=None, element_mask=None, sparse=False,
+                 validate_blocks=False, report_io=False, geometry=None,
+                 cache_socket=None, cube_budget=None):
         """Show header content in human-readable form
 
         Keyword arguments:
-        shape - tuple (rows, cols) of detector shape rows and cols.
+        shape - tuple (rows, cols) of detector shape rows and cols. May be None if
+                geometry is given.
         pixelsteps_per_buffer - Mapping Pixels Per Buffer setting.
         buffers_per_file - no. of buffers per group of p netCDF files.
+                 pixelsteps_per_buffer and buffers_per_file may be None, in which case
+                 they are read from the first file's buffer header and array shape.
         dirpaths - a filepath string or a list of filepath strings to the files.
         filepattern - a filename regex template whose capture group
                       is used to associate results across multiple files
@@ -155,11 +1234,70 @@ class DetectorData(object):
                       if only a single netCDF file is being accessed, e.g. 'ioc53_11.nc'
         mca_bins - no. of bins in MCA modules.
         first_file_n - e.g. 1 if first filename is ioc5[3-4]_1.nc
+        use_mmap - if True, module_data_cache entries are read-only views into
+                   memory-mapped files rather than data read into memory.
+        max_open_files - max no. of files kept mapped when use_mmap is True. Cache
+                   entries for a file are dropped when its mapping is closed and
+                   are re-read on the next access.
+        cache_bytes - max no. of bytes of data held in module_data_cache. Least
+                   recently used file groups are evicted to stay within it and
+                   re-read on their next access. None means unlimited. The spectrum
+                   cube isn't counted; see cube_budget.
+        rebin - no. of adjacent MCA bins summed into each bin of the spectra returned,
+                e.g. 4 gives 512-bin spectra from 2048-bin MCAs. Must divide mca_bins.
+                Spectra stay uint16 unless a rebinned count overflows it, after
+                which they are uint32.
+        step_window - optional (first, end) semi-open range of the scan's pixel_steps
+                to access, where end may be None for the end of the scan. pixel_steps
+                passed to and returned by all methods then count from first, files
+                holding only steps outside the window are never opened and all
+                arrays are sized to the window.
+        element_mask - optional sequence of rows * cols bools, True for elements to
+                exclude, e.g. dead channels. See set_element_mask().
+        sparse - if True, the cube holds only the non-zero bins of each spectrum in a
+                SparseSpectra store rather than a dense array.
+        validate_blocks - if True, the pixel header of every pixel block is checked as
+                files are decoded into the cube or statistics. Data of elements
+                failing the checks is left zero and the problems are printed.
+                See validate().
+        report_io - if True, print a summary of the file I/O and decoding done by
+                each load of the cube, statistics or validation. See io_stats().
+        geometry - optional DetectorGeometry, or the name of a registered one, e.g.
+                '100-element', giving the detector shape and the IOC, module and
+                channel of each element. By default the elements are taken to be wired
+                in order, with the modules split evenly across the files of a group.
+        cache_socket - optional path of the Unix socket of a cache_server shared by
+                the Sakura processes on this host. The cube and statistics are then
+                mapped read-only from shared memory if another process has already
+                decoded the scan, and a cube decoded here is shared with the others.
+        cube_budget - optional CubeBudget shared with other DetectorData instances,
+                limiting the bytes their spectrum cubes hold together
 
         """
-        self.shape = shape
+        if mca_bins % rebin:
+            raise ValueError('rebin={} does not divide mca_bins={}'.format(rebin, mca_bins))
+        self.geometry = None
+        if geometry is not None:
+            self.geometry = get_geometry(geometry)
+            if shape is not None and tuple(shape) != self.geometry.shape:
+                raise ValueError('shape {} differs from that of the {} geometry'.format(
+                    shape, self.geometry.name))
+            shape = self.geometry.shape
+        self.shape = tuple(shape)
         self.rows, self.cols = shape
         self.mca_bins = mca_bins
+        self.rebin = rebin
+        self.bins = mca_bins // rebin     # no. of bins of the spectra returned
+        # rebinned spectra stay uint16 until a sum overflows it; see _rebin()
+        self.spectrum_dtype = np.uint16
+        self.sparse = sparse
+        self.validate_blocks = validate_blocks
+        self.report_io = report_io
+        self.cache_socket = cache_socket
+        self.cube_budget = cube_budget
+        # per-file counters of bytes read and time spent opening, parsing, reading
+        # and decoding files
+        self.io_counters = IOStats()
         self.pixelsteps_per_buffer = pixelsteps_per_buffer
         self.buffers_per_file = buffers_per_file
 
@@ -168,12 +1306,50 @@ class DetectorData(object):
         self.dirpaths = dirpaths
         self.filepattern = filepattern
         self.first_file_n = first_file_n
+        self.first_step, self.end_step = step_window or (0, None)
+        self.element_mask = None
+        if element_mask is not None:
+            self.set_element_mask(element_mask)
+        # ArrayDataLayout of each IOC's files, keyed by _get_layout_key(filename)
+        self.layouts = {}
         self.file_paths_dict = self._get_all_file_groups()
-        self.files_indexed_by_pixel_step = self._get_file_paths_for_all_pixel_steps()
-        self.reverse_lookup_file_paths_dict = self._build_reverse_file_lookup(
-            self.files_indexed_by_pixel_step)
+        if pixelsteps_per_buffer is None or buffers_per_file is None:
+            self._detect_buffer_layout()
+        self._index_files()
         # Create data cache to implement single-file reading on any data access
-        self.module_data_cache = DataCache(self._default_cache_entry_factory)
+        self.module_data_cache = DataCache(self._default_cache_entry_factory,
+                                           max_bytes=cache_bytes)
+        self.use_mmap = use_mmap
+        self.mapped_files = MappedFilePool(
+            max_open_files, on_close=self._drop_file,
+            open_file=lambda path: self._open_file(path, use_mmap=True))
+        # Dense (steps, elements, bins) spectrum cube and (steps, elements)
+        # statistic arrays keyed by metric name. Filled by cube(), or the statistics
+        # alone by statistics_arrays().
+        self.spectra = None
+        self.statistics = None
+        # (workers, sidecar) arguments of the cube() call deferred by load_statistics()
+        # or release_cube(), and of the last cube() call that built the cube
+        self._deferred_cube = None
+        self._cube_args = (1, None)
+        # Per-spectrum running sums of the cube, shape (steps, elements, bins + 1),
+        # and the most recent roi_sums() result. Filled on the first roi_sums() call.
+        self.cumulative_spectra = None
+        self._last_roi = (None, None)
+        # Running sums of the cube over both pixel_steps and bins, shape
+        # (steps + 1, elements, bins + 1). Filled on the first window_sums() call.
+        self.summed_area_table = None
+        # Held while the cube and its derived arrays are replaced, and while the
+        # derived arrays are built or read, so that they always match
+        self._cube_lock = threading.RLock()
+        # pixel_number the XMAP gave pixel_step 0, found by _scan_pixel_number_offset()
+        self._pixel_number_offset = None
+        # Follow mode: functions called with a list of new pixel_steps by refresh(),
+        # and the sizes of newly seen files on the previous refresh
+        self.listeners = []
+        self._pending_file_sizes = {}
+        self._refresh_lock = threading.Lock()
+        self._stop_following = None
 
     def _get_all_file_groups(self):
         """Get the paths to netCDF files on disk corresponding to all available
@@ -231,6 +1407,38 @@ class DetectorData(object):
 
         return pathsdict
 
+    def _index_files(self):
+        """Build the file index, its reverse lookup and the location tables of the
+        available pixel_steps. The pixel_steps of the last file group end at the last
+        pixel its buffer headers report as filled, as the last buffer of a scan is
+        normally only partly filled. Those headers are only read if the files hold
+        several pixels, and not from files whose elements are all masked.
+
+        """
+        self.files_indexed_by_pixel_step = self._get_file_paths_for_all_pixel_steps()
+        self.reverse_lookup_file_paths_dict = self._build_reverse_file_lookup(
+            self.files_indexed_by_pixel_step)
+        self._build_location_tables()
+
+        steps = len(self.files_indexed_by_pixel_step)
+        steps_per_file = self.pixelsteps_per_buffer * self.buffers_per_file
+        if not steps or steps_per_file == 1:
+            return
+        paths = [path for path in self.files_indexed_by_pixel_step[steps - 1]
+                 if len(self._get_elements_to_read(os.path.basename(path)))]
+        if not paths:
+            return
+        # first pixel_step of the last group, counting from the step window
+        group_step = (steps - 1 + self.first_step) // steps_per_file * steps_per_file
+        filled = min(self._count_steps_in_file(path) for path in paths)
+        end_step = max(0, group_step + filled - self.first_step)
+        if end_step < steps:
+            for pixel_step in range(end_step, steps):
+                del self.files_indexed_by_pixel_step[pixel_step]
+            self.reverse_lookup_file_paths_dict = self._build_reverse_file_lookup(
+                self.files_indexed_by_pixel_step)
+            self._build_location_tables()
+
     def _build_reverse_file_lookup(self, d):
         """Builds a dictionary of pixel_steps keyed by the corresponding file basename.
         e.g. an arbitrary example of an entry might be 'ioc53_10.nc':[24,25,26]
@@ -259,24 +1467,75 @@ class DetectorData(object):
 
         return stepdict
 
-    @memoize
     def _get_file_paths_for_pixel_step(self, pixel_step):
         """Get the paths to netCDF files on disk corresponding to a given
         pixel_step, sorted based on filename.
-        Raises an IndexError if files are not found.
 
         Keyword arguments:
-        pixel_step - 0-based int.
+        pixel_step - 0-based int, counting from the start of the step window.
 
         Returns:
-        list of full paths to files for the specified pixel_step.
+        list of full paths to files for the specified pixel_step, empty if files
+        are not found or the pixel_step is beyond the step window.
 
         """
+        pixel_step += self.first_step
+        if self.end_step is not None and pixel_step >= self.end_step:
+            return []
         file_n = self.first_file_n + pixel_step // (
             self.pixelsteps_per_buffer * self.buffers_per_file)
-        return self.file_paths_dict[file_n]
+        return self.file_paths_dict.get(file_n, [])
+
+    def _build_location_tables(self):
+        """Compute the lookup tables that locate the data of every pixel_step and
+        detector element within the netCDF files:
+        self.file_groups - (steps,) file group no. containing each pixel_step
+        self.file_ix, self.buffer_ix, self.pixel_ix, self.module_ix, self.channel -
+            (steps, elements) tables of the file index within the group, buffer index
+            within the file, pixel block index within the buffer, module index within
+            the file and channel within the module, where the element index is
+            row * cols + col
+        self.element_geometry - the DetectorGeometry the element tables come from
+        The element tables come from the detector geometry. Without one, the
+        modules are assumed to be split evenly across the files of a group in
+        increasing sequential order. The (steps, elements) tables are read-only
+        broadcast views, so they take no more memory than their distinct values.
+
+        """
+        steps = len(self.files_indexed_by_pixel_step)
+        geometry = self.geometry
+        if geometry is None:
+            files_per_group = max(1, len(self.file_paths_dict.get(self.first_file_n, [])))
+            geometry = DetectorGeometry.sequential(self.shape, files_per_group)
+        self.element_geometry = geometry
+        self.elements_by_file = geometry.elements_by_ioc
+        self.modules_per_file = max(geometry.modules_per_ioc)
+
+        pixel_steps = np.arange(steps) + self.first_step     # scan pixel_steps
+        self.file_groups = self.first_file_n + pixel_steps // (
+            self.pixelsteps_per_buffer * self.buffers_per_file)
+
+        shape = (steps, geometry.elements)
+        self.file_ix = np.broadcast_to(geometry.ioc_ix, shape)
+        self.module_ix = np.broadcast_to(geometry.module_ix, shape)
+        self.channel = np.broadcast_to(geometry.channel, shape)
+        buffer_ix, pixel_ix = np.divmod(
+            pixel_steps % (self.pixelsteps_per_buffer * self.buffers_per_file),
+            self.pixelsteps_per_buffer)
+        self.buffer_ix = np.broadcast_to(buffer_ix[:, np.newaxis], shape)
+        self.pixel_ix = np.broadcast_to(pixel_ix[:, np.newaxis], shape)
+
+    def _count_complete_steps(self):
+        """Return the no. of leading pixel_steps whose file groups have as many files
+        as the first group, i.e. no file is missing.
+
+        """
+        files_per_group = len(self.file_paths_dict.get(self.first_file_n, []))
+        for pixel_step in range(len(self.files_indexed_by_pixel_step)):
+            if len(self.files_indexed_by_pixel_step[pixel_step]) < files_per_group:
+                return pixel_step
+        return len(self.files_indexed_by_pixel_step)
 
-    @memoize
     def _get_data_location(self, pixel_step, row, col):
         """Locate the data buffer corresponding to the
         pixel_step, row and col.
@@ -293,27 +1552,93 @@ class DetectorData(object):
         channel - 0-3
 
         """
-        # determine files to read
-        filepaths = self._get_file_paths_for_pixel_step(pixel_step)
+        element = row * self.cols + col
+        path = self.file_paths_dict[self.file_groups[pixel_step]][
+            self.file_ix[pixel_step, element]]
+        return (path, int(self.buffer_ix[pixel_step, element]),
+                int(self.module_ix[pixel_step, element]),
+                int(self.channel[pixel_step, element]))
 
-        # Get module index from element index
-        module_ix, channel = divmod(row * self.rows + col, CHANNELS_PER_MODULE)
+    def _get_elements_in_file(self, filename):
+        """Given a filename, returns the detector elements it contains.
 
-        # Now get the file and module index within that file by assuming the modules are
-        # split evenly across the IOCs and are in increasing sequential order
-        number_of_files = len(filepaths)
-        number_of_detector_elements = self.rows * self.cols
-        file_split_value = int(np.ceil(float(
-            number_of_detector_elements / CHANNELS_PER_MODULE) / number_of_files))
-        file_ix, module_ix = divmod(module_ix, file_split_value)
+        Keyword arguments:
+        filename - string e.g. 'ioc53_1.nc'
 
-        # Get a netCDF file path
-        path = filepaths[file_ix]
+        Returns:
+        A 1-D array of 0-based element indices in increasing order
+
+        """
+        pixel_step = self.reverse_lookup_file_paths_dict[filename][0]
+        paths = self.file_paths_dict[self.file_groups[pixel_step]]
+        file_index = [os.path.basename(f) for f in paths].index(filename)
+        return self.elements_by_file[file_index]
 
-        # Get buffer index from module_ix and pixel_step
-        buffer_ix = pixel_step % self.pixelsteps_per_buffer
+    def _get_elements_to_read(self, filename):
+        """Given a filename, returns the detector elements it contains that aren't
+        excluded by the element mask, as a 1-D array of 0-based element indices in
+        increasing order.
 
-        return path, buffer_ix, module_ix, channel
+        """
+        elements = self._get_elements_in_file(filename)
+        if self.element_mask is not None:
+            elements = elements[~self.element_mask[elements]]
+        return elements
+
+    def _skips_modules(self, filename):
+        """Return True if the element mask excludes every channel of any module in
+        the file, whose data then needn't be read.
+
+        """
+        if self.element_mask is None:
+            return False
+        file_modules = self.module_ix[0, self._get_elements_in_file(filename)]
+        modules = self.module_ix[0, self._get_elements_to_read(filename)]
+        return len(np.unique(modules)) < len(np.unique(file_modules))
+
+    def set_element_mask(self, element_mask):
+        """Exclude elements from reading and decoding. Whole files whose channels are
+        all excluded are never opened. Files with modules whose channels are all
+        excluded are memory-mapped rather than read, so that only the pages holding
+        the other modules are read from disk. Any cached data for excluded
+        elements is dropped. Excluded elements have zero spectra and statistics in
+        arrays decoded afterwards, so set the mask before building the cube to save
+        its decoding time. Data already decoded into the cube is kept.
+
+        Keyword arguments:
+        element_mask - sequence of rows * cols bools, True for elements to exclude,
+                       where the element index is row * cols + col, or None to
+                       include every element
+
+        """
+        if element_mask is None:
+            self.element_mask = None
+            return
+        element_mask = np.array(element_mask, dtype=bool)
+        if element_mask.shape != (self.rows * self.cols,):
+            raise ValueError('element_mask must have {} entries'.format(
+                self.rows * self.cols))
+        self.element_mask = element_mask
+        if hasattr(self, 'module_data_cache'):
+            cache = self.module_data_cache
+            with cache.lock:
+                cache.remove_entries([key for key in cache.keys()
+                                      if element_mask[key[1] * self.cols + key[2]]])
+
+    def _get_element_range_in_file(self, filename):
+        """Given a filename, returns the range of detector elements it contains.
+
+        Keyword arguments:
+        filename - string e.g. 'ioc53_1.nc'
+
+        Returns:
+        A 3-tuple (low_element, high_element_plus1, modules_per_file), where
+        low_element, high_element_plus1 - semi-open range of 0-based element indices
+        modules_per_file - no. of modules in all but possibly the last file of a group
+
+        """
+        elements = self._get_elements_in_file(filename)
+        return int(elements[0]), int(elements[-1]) + 1, self.modules_per_file
 
     def _enumerate_all_data_indices_in_file(self, filename):
         """Given a filename, returns a list of tuples
@@ -332,46 +1657,16 @@ class DetectorData(object):
             module_ix - 0 -> max_module-1 for the current file.
 
         """
-        # pixel step range for this file
-        pixel_steps = self.reverse_lookup_file_paths_dict[filename]
-        # get element range for this file, e.g. 0, 51 (first 52 of 100-element detector)
-        p = len(self.file_paths_dict[self.first_file_n])
-        m = self.rows * self.cols / CHANNELS_PER_MODULE
-        modules_per_file = int(np.ceil(float(m) / p))
-
-        # now we have modules_per_file, get the file index so we can determine the
-        # element range
-        files_for_this_step = self._get_file_paths_for_pixel_step(pixel_steps[0])
-        files_for_this_step = [os.path.basename(f) for f in files_for_this_step]
-        file_index = files_for_this_step.index(filename)
-
-        # if e.g. file_index==n, range is
-        # n*elements_in_file -> (n+1)*elements_in_file-1.
-        elements_per_file = modules_per_file * CHANNELS_PER_MODULE
-        low_element = file_index * elements_per_file
-        # The last file in a group may contain fewer elements.
-        if files_for_this_step[-1] == filename:
-            high_element_plus1 = self.rows * self.cols
-        else: 
-            high_element_plus1 = (file_index + 1) * elements_per_file
-
-        # Now collect the tuples
-        indices = []
-        for pixel_step in pixel_steps:
-            for el in range(low_element, high_element_plus1):
-                row, col = divmod(el, self.cols)
-
-                # Get module index from element index
-                module_ix, channel = divmod(row * self.rows + col, CHANNELS_PER_MODULE)
-
-                # Now get the file and module index within that file by assuming the
-                # modules are split evenly across the IOCs and are in increasing
-                # sequential order
-                module_ix = module_ix % modules_per_file
-                buffer_ix = pixel_step % self.pixelsteps_per_buffer
-                indices.append( (pixel_step, row, col, channel, buffer_ix, module_ix) )
-
-        return indices
+        # gather the table entries for all pixel steps and elements in this file
+        pixel_steps = np.array(self.reverse_lookup_file_paths_dict[filename])
+        elements = self._get_elements_to_read(filename)
+        steps_grid, elements_grid = np.meshgrid(pixel_steps, elements, indexing='ij')
+        rows, cols = np.divmod(elements_grid, self.cols)
+        columns = [steps_grid, rows, cols,
+                   self.channel[steps_grid, elements_grid],
+                   self.buffer_ix[steps_grid, elements_grid],
+                   self.module_ix[steps_grid, elements_grid]]
+        return zip(*[c.ravel().tolist() for c in columns])
 
     def _default_cache_entry_factory(self, key):
         """Called on a DataCache access __missing__() call.
@@ -384,21 +1679,371 @@ class DetectorData(object):
         """
         # A cache miss will generate a file lookup, read and cache of the associated data.
         path, _, _, _ = self._get_data_location(*key)   # path of file containing our data
+        self.io_counters.add(os.path.basename(path), cache_misses=1)
+        entries = self._read_cache_entries(path)
+        self.module_data_cache.update_entries(entries, self._get_file_group(path))
+        return entries[key]
+
+    def _get_file_group(self, path):
+        """Return the file group no., i.e. the filepattern capture group value, of the
+        netCDF file path.
+
+        """
+        pixel_step = self.reverse_lookup_file_paths_dict[os.path.basename(path)][0]
+        return int(self.file_groups[pixel_step])
+
+    def _get_layout_key(self, filename):
+        """Return the filename with its filepattern capture group removed, e.g.
+        ioc53_.nc for ioc53_11.nc, which identifies the IOC that wrote it.
 
-        # Generate all the entries like the following for data in the file path
-        # {(step, row, col): [module_data object reference, 0-3], ... }
+        """
+        match = re.match(self.filepattern, filename)
+        if match is None or not match.groups():
+            return filename
+        return filename[:match.start(1)] + filename[match.end(1):]
+
+    def _open_file(self, path, use_mmap=False):
+        """Open the netCDF file path, reusing the array_data layout of earlier files
+        from the same IOC when the file matches it.
+
+        """
+        filename = os.path.basename(path)
+        key = self._get_layout_key(filename)
+        start = time.time()
+        f = open_netcdf(path, use_mmap, self.layouts.get(key))
+        layout = getattr(f, 'layout', None)
+        if layout is not None:
+            self.layouts[key] = layout
+            self.io_counters.add(filename, opens=1, bytes_read=f.bytes_read,
+                                 open_time=f.open_time, parse_time=f.parse_time)
+        else:
+            # read by netcdf_file, which reads the whole file unless it is mapped
+            self.io_counters.add(filename, opens=1, open_time=time.time() - start,
+                                 bytes_read=0 if use_mmap else os.path.getsize(path))
+        return f
+
+    def _read_cache_entries(self, path):
+        """Read all data from the file path without touching module_data_cache.
+
+        Arguments:
+        path - netCDF file path
+
+        Returns:
+        A dict of all the entries like the following for data in the file path
+        {(step, row, col): [module_data object reference, 0-3], ... }
+
+        """
         # First, enumerate data indices in current file.
         indices = self._enumerate_all_data_indices_in_file(os.path.basename(path))
-
-        # OK, now read everything from the file
-        f = netcdf_file(path, 'r')
+        if not indices:
+            return {}    # every element in the file is masked
+
+        # OK, now read everything from the file, or just the modules wanted if the
+        # element mask skips any
+        partial = not self.use_mmap and self._skips_modules(os.path.basename(path))
+        if self.use_mmap:
+            f = self.mapped_files.open(path)
+        else:
+            f = self._open_file(path, use_mmap=partial)
+        start = time.time()
+        entries = {}
+        module_data = {}    # one data array shared by the channels of each module
         # buffer_ix, module_ix
         for pixel_step, row, col, channel, buffer_ix, module_ix in indices:
-            self.module_data_cache[(pixel_step, row, col)] = \
-                [self._get_mode1_pixel_data(f, buffer_ix, module_ix), channel]
-        f.close()
+            pixel_ix = self.pixel_ix[pixel_step, 0]
+            data = module_data.get((buffer_ix, pixel_ix, module_ix))
+            if data is None:
+                data = self._get_mode1_pixel_data(f, buffer_ix, module_ix, pixel_ix)
+                if self.use_mmap:
+                    data.flags.writeable = False
+                elif partial:
+                    data = data.copy()      # so the mapping is released on close
+                module_data[(buffer_ix, pixel_ix, module_ix)] = data
+            entries[(pixel_step, row, col)] = [data, channel]
+        if not self.use_mmap:
+            f.close()
+        # data copied from a mapped file is the only data read from it
+        bytes_read = sum(data.nbytes for data in module_data.itervalues()) if partial else 0
+        self.io_counters.add(os.path.basename(path), read_time=time.time() - start,
+                             bytes_read=bytes_read)
+
+        return entries
+
+    def _get_file_paths_for_pixel_steps(self, pixel_steps):
+        """Get the paths to all the files containing data for the given pixel_steps.
+
+        Keyword arguments:
+        pixel_steps - iterable of 0-based pixel_step indices
+
+        Returns:
+        A list of (pixel_step, path) tuples, one per file, in pixel_step order, where
+        pixel_step is the first of pixel_steps contained in the file.
+
+        """
+        paths = []
+        seen = set()
+        for pixel_step in sorted(pixel_steps):
+            for path in self.files_indexed_by_pixel_step.get(pixel_step, []):
+                if path not in seen:
+                    seen.add(path)
+                    paths.append((pixel_step, path))
+        return paths
+
+    def preload(self, steps=None, workers=4):
+        """Read and decode the files for the given pixel_steps concurrently on a
+        pool of worker threads, filling module_data_cache ahead of access.
+        Files that can't be read are reported and skipped; accessing their data
+        later raises the error in the usual way.
+        With use_mmap, each file is mapped and its entries cached under the cache
+        lock, which is quick, and its pages are then read concurrently. At most
+        max_open_files files, those of the earliest pixel_steps, are preloaded, as
+        the pool would close the first ones again to open the rest.
+
+        Keyword arguments:
+        steps - iterable of 0-based pixel_steps to load. None loads all steps.
+        workers - no. of worker threads
+
+        """
+        if steps is None:
+            steps = self.files_indexed_by_pixel_step
+        paths = [path for _, path in self._get_file_paths_for_pixel_steps(steps)]
+        if self.use_mmap:
+            paths = paths[:self.mapped_files.max_open]
+
+        cache = self.module_data_cache
+
+        def read(path):
+            try:
+                if self.use_mmap:
+                    # the pool may close the file again as soon as the lock is
+                    # released, so its entries must be cached before then
+                    with cache.lock:
+                        entries = self._read_cache_entries(path)
+                        cache.update_entries(entries, self._get_file_group(path))
+                    # the entries' views keep the mapping valid even if the file is
+                    # closed, so its pages can be read without the lock
+                    _touch_pages(entries)
+                else:
+                    cache.update_entries(self._read_cache_entries(path),
+                                         self._get_file_group(path))
+            except Exception as exc:
+                return path, exc
+            return path, None
+
+        pool = ThreadPool(workers)
+        try:
+            for path, exc in pool.imap_unordered(read, paths):
+                if exc is not None:
+                    print 'could not preload', path, exc
+        finally:
+            pool.close()
+            pool.join()
+
+    def _drop_file(self, path):
+        """Remove all module_data_cache entries holding data read from the file path.
+        Called by the mapped file pool before it closes a file.
+
+        """
+        indices = self._enumerate_all_data_indices_in_file(os.path.basename(path))
+        self.module_data_cache.remove_entries(
+            [(pixel_step, row, col) for pixel_step, row, col, _, _, _ in indices])
+
+    def close(self):
+        """Close all memory-mapped files, dropping the cache entries that refer to them.
+        """
+        # take the cache lock first, as readers do, before the pool lock
+        with self.module_data_cache.lock:
+            self.mapped_files.close_all()
 
-        return self.module_data_cache[key]
+    def add_listener(self, fn):
+        """Register fn(pixel_steps) to be called by refresh() with a list of the
+        pixel_steps that became available. When following, it is called from the
+        follow thread.
+
+        """
+        self.listeners.append(fn)
+
+    def refresh(self):
+        """Add any file groups written since the file index was built, e.g. during an
+        in-progress scan. A new file group is added once it has as many files as the
+        first group and their sizes haven't changed since the previous refresh, i.e.
+        they have been completely written. If the cube or statistics arrays have been
+        built, the new files are decoded into them and any that can't be decoded yet
+        are retried on the next refresh.
+
+        Returns:
+        A list of the pixel_steps that became available. Listeners are called with it
+        if it isn't empty.
+
+        """
+        with self._refresh_lock:
+            old_steps = self._available_steps()
+            self._add_complete_file_groups()
+            end_step = self._count_complete_steps()
+            if end_step > old_steps:
+                if self.spectra is not None:
+                    end_step = self._extend_cube(old_steps, end_step)
+                elif self.statistics is not None:
+                    end_step = self._extend_statistics(old_steps, end_step)
+            new_steps = range(old_steps, max(old_steps, end_step))
+
+        if new_steps:
+            for fn in self.listeners:
+                fn(new_steps)
+        return new_steps
+
+    def _available_steps(self):
+        """Return the no. of pixel_steps available to consumers."""
+        if self.spectra is not None:
+            return len(self.spectra)
+        if self.statistics is not None:
+            return len(self.statistics[STATISTICS[0]])
+        return len(self.files_indexed_by_pixel_step)
+
+    def _add_complete_file_groups(self):
+        """Rescan the directories and add completely written new file groups to the
+        file index.
+
+        """
+        reference = self.file_paths_dict.get(self.first_file_n, [])
+        sizes = {}
+        for file_n, paths in self._get_all_file_groups().iteritems():
+            if len(paths) == len(self.file_paths_dict.get(file_n, [])):
+                continue
+            for path in paths:
+                try:
+                    sizes[path] = os.path.getsize(path)
+                except OSError:
+                    sizes[path] = None      # removed since the directory was listed
+            if (not reference or len(paths) == len(reference)) and all(
+                    sizes[path] is not None and
+                    sizes[path] == self._pending_file_sizes.get(path) for path in paths):
+                self.file_paths_dict[file_n] = paths
+        self._pending_file_sizes = sizes
+        self._index_files()
+
+    def _extend_cube(self, first_step, end_step):
+        """Decode pixel_steps [first_step, end_step) into the cube and statistics arrays,
+        extending them and any cumulative spectra. The new pixel_steps are decoded
+        into extended copies, which replace the arrays under _cube_lock once they
+        are complete, so readers never see pixel_steps that aren't decoded yet.
+
+        Returns:
+        The pixel_step following the last one decoded
+
+        """
+        sparse = isinstance(self.spectra, SparseSpectra)
+        last_step = end_step
+        while True:
+            dtype = self.spectrum_dtype
+            if sparse:
+                spectra = self.spectra.resized(last_step, dtype)
+            else:
+                spectra = _grow_steps(self.spectra.astype(dtype, copy=False), last_step)
+            statistics = {metric: _grow_steps(self.statistics[metric], last_step)
+                          for metric in STATISTICS}
+            end_step = self._decode_all_files(
+                self._file_stages(spectra, statistics),
+                first_step, last_step, report=False)
+            if self.spectrum_dtype == dtype:
+                break
+            print 'rebinned counts overflow {}, decoding as {}'.format(
+                np.dtype(dtype).name, np.dtype(self.spectrum_dtype).name)
+        if sparse:
+            spectra.resize(end_step)
+        else:
+            spectra = spectra[:end_step]
+
+        with self._cube_lock:
+            # built by roi_sums() while the new pixel_steps were decoded, if not before
+            if self.cumulative_spectra is not None:
+                cumulative = _grow_steps(self.cumulative_spectra, end_step)
+                np.cumsum(spectra[first_step:end_step], axis=2, dtype=np.uint32,
+                          out=cumulative[first_step:end_step, :, 1:])
+                self.cumulative_spectra = cumulative
+            self._last_roi = (None, None)
+            self.summed_area_table = None      # rebuilt on the next window_sums()
+            self.spectra = spectra
+            self.statistics = {metric: statistics[metric][:end_step]
+                               for metric in STATISTICS}
+        self._use_budget(resized=True)
+        return end_step
+
+    def _extend_statistics(self, first_step, end_step):
+        """Decode the statistics of pixel_steps [first_step, end_step), extending the
+        statistics arrays.
+
+        Returns:
+        The pixel_step following the last one decoded
+
+        """
+        statistics = {metric: _grow_steps(self.statistics[metric], end_step)
+                      for metric in STATISTICS}
+        end_step = self._decode_all_files(
+            self._file_stages(statistics=statistics),
+            first_step, end_step, report=False)
+        self.statistics = {metric: statistics[metric][:end_step] for metric in STATISTICS}
+        return end_step
+
+    def follow(self, interval=2.0):
+        """Call refresh() every interval seconds on a background thread until
+        stop_following() is called.
+
+        """
+        if self._stop_following is not None:
+            return
+        stop = self._stop_following = threading.Event()
+
+        def poll():
+            while not stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as exc:
+                    print 'refresh failed', exc
+
+        thread = threading.Thread(target=poll, name='DetectorData.follow')
+        thread.daemon = True
+        thread.start()
+
+    def stop_following(self):
+        if self._stop_following is not None:
+            self._stop_following.set()
+            self._stop_following = None
+
+    def io_stats(self, per_file=False):
+        """Return the file I/O done so far, to tell whether loads are limited by the
+        filesystem, netCDF header parsing or decoding.
+
+        Keyword arguments:
+        per_file - if True, also return the counters of each file
+
+        Returns:
+        A dict of the IOStats counters summed over all files, plus cache_hits, the
+        no. of module_data_cache lookups served without reading a file. With
+        per_file, a tuple (totals, files) where files is a dict of the counters keyed
+        by filename.
+
+        """
+        totals = self.io_counters.totals()
+        cache = self.module_data_cache
+        totals['cache_hits'] = cache.lookups - cache.misses
+        if per_file:
+            with self.io_counters.lock:
+                files = {filename: dict(counts)
+                         for filename, counts in self.io_counters.files.iteritems()}
+            return totals, files
+        return totals
+
+    def nbytes(self):
+        """Return the no. of bytes of decoded data currently held, i.e. in
+        module_data_cache, the spectrum cube and its derived arrays.
+
+        """
+        arrays = [self.spectra, self.cumulative_spectra, self.summed_area_table]
+        if self.statistics is not None:
+            arrays.extend(self.statistics.values())
+        return self.module_data_cache.nbytes + sum(
+            a.nbytes for a in arrays if a is not None)
 
     def _uint32_swap_words(self, item_array):
         """Deal with 32-bit uint32 items properly turning them into numpy np.uint32 values
@@ -409,14 +2054,15 @@ class DetectorData(object):
                 i['f1'].astype(np.uint32) << 16) + i['f0'].astype(np.uint32)
         return item_array
 
-    def _get_mode1_pixel_data(self, f, buffer_ix, module_ix):
+    def _get_mode1_pixel_data(self, f, buffer_ix, module_ix, pixel_ix=0):
         """Return the pixel data corresponding to mapping mode 1 and indexed by
-        buffer_ix, module_ix
+        buffer_ix, module_ix, pixel_ix
 
         Keyword arguments:
         f - netCDF file handle
         buffer_ix - 0-based int referring to buffer contained in netCDF file.
         module_ix - 0 -> max_module-1 for the current file.
+        pixel_ix - 0-based int referring to pixel block contained in the buffer.
 
         Returns:
         An ndarray view with dtype=pixel_header_mode1_static_fixedbins_dtype
@@ -424,10 +2070,923 @@ class DetectorData(object):
         """
         array_data = f.variables['array_data']
         module_data = array_data[buffer_ix, module_ix, :]
-        data = module_data[256: 256 + 256 + 4 * self.mca_bins]  # skip buffer header
+        block_size = 256 + 4 * self.mca_bins
+        offset = 256 + pixel_ix * block_size    # skip buffer header and earlier pixels
+        data = module_data[offset: offset + block_size]
         dynamic_data = data.view(pixel_header_mode1_static_fixedbins_dtype(self.mca_bins))
         return dynamic_data
 
+    def cube(self, workers=1, sidecar=None, on_decoded=None):
+        """Return the dense spectrum cube, decoding all available files on first use.
+        Each file is read once and decoded straight into contiguous arrays, bypassing
+        the per-(pixel_step, row, col) module_data_cache entries. Once the cube is
+        built, spectrum() and statistic() are served from it and self.statistics holds
+        a (steps, elements) uint32 array for each metric in STATISTICS.
+
+        Keyword arguments:
+        workers - no. of threads used to read and decode files when building the cube
+        sidecar - optional path of a sidecar cube file. If it matches the current
+                  netCDF files (see fingerprint()), the arrays are mapped from it
+                  read-only instead of being decoded. Otherwise the cube is decoded
+                  and written to it for next time.
+        on_decoded - optional function called with (first, end, spectra, statistics)
+                  on the calling thread as soon as pixel_steps [first, end) of the
+                  spectra and statistics arrays being filled are decoded, in
+                  pixel_step order. With workers > 1 files are read and decoded on
+                  separate threads (see staged_imap()), so early pixel_steps can be
+                  processed while later files are still being read. If the cube
+                  needn't be decoded, it is called once for all pixel_steps.
+
+        Returns:
+        An ndarray of shape (steps, elements, bins) and dtype spectrum_dtype, where
+        the element index is row * cols + col, or a SparseSpectra store of the same
+        shape if the sparse option is set.
+
+        """
+        if self.spectra is None:
+            self._cube_args = (workers, sidecar)
+            fingerprint = None
+            if sidecar is not None or self.cache_socket is not None:
+                fingerprint = self.fingerprint()
+            shared = None
+            if self.cache_socket is not None:
+                shared = self._attach_shared_cube(fingerprint, build=True)
+            if shared is True:
+                pass
+            elif sidecar is None:
+                self._build_cube(workers, on_decoded)
+                on_decoded = None
+            elif not self._load_sidecar(sidecar, fingerprint):
+                self._build_cube(workers, on_decoded)
+                on_decoded = None
+                self._save_sidecar(sidecar, fingerprint)
+            if shared not in (None, True):
+                self._share_cube(shared, fingerprint)
+            self._use_budget(resized=True)
+        if on_decoded is not None and len(self.spectra):
+            on_decoded(0, len(self.spectra), self.spectra, self.statistics)
+        return self.spectra
+
+    def fingerprint(self):
+        """Return a string identifying the netCDF files and the reader settings used to
+        decode them. It changes whenever a file is added, removed, resized or modified.
+
+        """
+        items = [self.shape, self.mca_bins, self.rebin, self.pixelsteps_per_buffer,
+                 self.buffers_per_file, self.first_file_n, self.first_step, self.end_step,
+                 self.sparse, self.validate_blocks]
+        if self.element_mask is not None:
+            items.append(np.flatnonzero(self.element_mask).tolist())
+        # the element wiring, as cubes decoded under another wiring hold other data
+        geometry = self.element_geometry
+        items.append((geometry.modules_per_ioc, geometry.ioc_ix.tolist(),
+                      geometry.module_ix.tolist(), geometry.channel.tolist()))
+        for file_n in sorted(set(self.file_groups)):
+            for path in self.file_paths_dict[file_n]:
+                st = os.stat(path)
+                items.append((os.path.basename(path), st.st_size, st.st_mtime))
+        return hashlib.md5(repr(items)).hexdigest()
+
+    def load_statistics(self, workers=1, sidecar=None):
+        """Load the channel statistics without the spectra, deferring cube(workers,
+        sidecar) until spectrum() or roi_sums() first needs the spectra. Only the
+        256-word pixel headers are decoded, so dead-time correction and count rate
+        checks can start long before the spectra would have been loaded. An up to
+        date sidecar file is mapped instead, providing the spectra at no extra cost.
+
+        Keyword arguments:
+        workers - no. of threads used to read and decode files
+        sidecar - optional path of a sidecar cube file, see cube()
+
+        Returns:
+        The dict of (steps, elements) statistic arrays, see statistics_arrays()
+
+        """
+        if self.spectra is None:
+            fingerprint = None
+            if sidecar is not None or self.cache_socket is not None:
+                fingerprint = self.fingerprint()
+            if self.cache_socket is not None and \
+                    self._attach_shared_cube(fingerprint) is True:
+                pass
+            elif sidecar is None or not self._load_sidecar(sidecar, fingerprint):
+                self._deferred_cube = (workers, sidecar)
+        return self.statistics_arrays(workers)
+
+    def has_cube(self):
+        """Return True if the spectrum cube is built or will be built on first use."""
+        return self.spectra is not None or self._deferred_cube is not None
+
+    def _ensure_cube(self, build=False):
+        """Build the cube deferred by load_statistics() or release_cube(), if any.
+
+        Keyword arguments:
+        build - if True, build the cube with cube()'s defaults if it was never requested
+
+        """
+        if self.spectra is None and self._deferred_cube is not None:
+            workers, sidecar = self._deferred_cube
+            self.cube(workers, sidecar)
+            self._deferred_cube = None
+        elif self.spectra is None and build:
+            self.cube()
+        elif self.spectra is not None:
+            self._use_budget()
+
+    def release_cube(self):
+        """Drop the spectrum cube and the arrays derived from it, e.g. to free memory
+        for other scans. The cube is built again, or mapped again from its sidecar or
+        the cache server, on its next use. The statistics arrays are kept.
+
+        """
+        with self._cube_lock:
+            if self.spectra is None:
+                return
+            self._deferred_cube = self._cube_args
+            self.spectra = None
+            self.cumulative_spectra = None
+            self._last_roi = (None, None)
+            self.summed_area_table = None
+
+    def cube_nbytes(self):
+        """Return the no. of bytes held in memory by the spectrum cube, its derived
+        arrays and the statistics arrays, not counting arrays mapped from files.
+
+        """
+        arrays = [self.spectra, self.cumulative_spectra, self.summed_area_table]
+        if self.statistics is not None:
+            arrays.extend(self.statistics.values())
+        return sum(a.nbytes for a in arrays
+                   if a is not None and not isinstance(a, np.memmap))
+
+    def _use_budget(self, resized=False):
+        if self.cube_budget is not None:
+            self.cube_budget.use(self, resized)
+
+    def _attach_shared_cube(self, fingerprint, build=False):
+        """Map the cube and statistics read-only from the cache server, if it holds
+        them. Failure to reach the server is reported but otherwise ignored.
+
+        Keyword arguments:
+        fingerprint - see fingerprint()
+        build - if True, offer to build the cube if the server doesn't hold it
+
+        Returns:
+        True if the arrays were mapped, the server's reply if it asks for the cube to
+        be built and shared with _share_cube(), else None
+
+        """
+        try:
+            reply = cache_server.request(self.cache_socket, op='get' if build else 'lookup',
+                                         fingerprint=fingerprint)
+        except (IOError, ValueError) as exc:
+            print 'cache server unavailable', exc
+            return None
+        if reply.get('status') == 'build':
+            return reply
+        if reply.get('status') != 'ready':
+            return None
+        return self._map_shared_cube(reply['path'], fingerprint)
+
+    def _map_shared_cube(self, path, fingerprint):
+        """Map the cube and statistics from the cache server's directory path.
+
+        Returns:
+        True if the arrays were mapped, else None
+
+        """
+        try:
+            descriptor, arrays = read_export(path)
+        except (IOError, OSError, ValueError) as exc:
+            # e.g. evicted since the reply
+            print 'could not map shared cube', exc
+            return None
+        if descriptor.get('fingerprint') != fingerprint:
+            return None
+        self._set_cube_columns(arrays)
+        return True
+
+    def _share_cube(self, reply, fingerprint):
+        """Export the cube into a private directory at the path the cache server gave
+        in reply, and hand it to the server, or tell it the export failed. A sparse
+        cube is exported as the columns of its store, as in a sidecar file, rather
+        than dense. Once the server holds the cube, it is mapped from there,
+        releasing this instance's own arrays so that the host holds one copy.
+
+        """
+        path = reply['path']
+        created = False
+        try:
+            # nobody else may write the files before the server has them
+            os.mkdir(path, 0o700)
+            created = True
+            write_export(path, self._cube_columns(), {'fingerprint': fingerprint})
+            for name in os.listdir(path):
+                os.chmod(os.path.join(path, name), 0o644)
+            os.chmod(path, 0o755)
+            op = 'put'
+        except (IOError, OSError) as exc:
+            print 'could not share cube', exc
+            op = 'abort'
+        try:
+            reply = cache_server.request(self.cache_socket, op=op, fingerprint=fingerprint,
+                                         token=reply['token'])
+        except (IOError, ValueError) as exc:
+            print 'cache server unavailable', exc
+            reply = {}
+        finally:
+            # the server moves or copies the directory; remove what is left of it
+            if created:
+                shutil.rmtree(path, ignore_errors=True)
+        if reply.get('status') == 'ready':
+            self._map_shared_cube(reply['path'], fingerprint)
+
+    def _load_sidecar(self, path, fingerprint):
+        """Map the cube and statistics from a sidecar file if it is up to date.
+
+        Returns:
+        True if the arrays were mapped, False if the sidecar is missing or stale.
+
+        """
+        columns = read_sidecar(path, fingerprint)
+        if columns is None:
+            return False
+        self._set_cube_columns(columns)
+        return True
+
+    def _cube_columns(self):
+        """Return the arrays holding the cube and statistics keyed by name: spectra and
+        the metrics, with a sparse cube as the columns of its store prefixed sparse_.
+
+        """
+        columns = dict(self.statistics)
+        if isinstance(self.spectra, SparseSpectra):
+            columns.update(('sparse_' + name, column)
+                           for name, column in self.spectra.columns().iteritems())
+        else:
+            columns['spectra'] = self.spectra
+        return columns
+
+    def _set_cube_columns(self, columns):
+        """Use the cube and statistics arrays returned by _cube_columns(), e.g. mapped
+        from a sidecar file or the cache server.
+
+        """
+        if 'spectra' in columns:
+            self.spectra = columns['spectra']
+        else:
+            self.spectra = SparseSpectra.from_columns(
+                {name[len('sparse_'):]: column for name, column in columns.iteritems()
+                 if name.startswith('sparse_')}, self.bins)
+        self.statistics = {metric: columns[metric] for metric in STATISTICS}
+        # spectra added by refresh() are decoded as wide as those of a rebinned cube
+        self.spectrum_dtype = np.promote_types(self.spectrum_dtype, self.spectra.dtype).type
+
+    def _save_sidecar(self, path, fingerprint):
+        """Write the cube and statistics to a sidecar file. Failure, e.g. because the
+        scan directory is read-only, is reported but otherwise ignored.
+
+        """
+        try:
+            write_sidecar(path, self._cube_columns(), fingerprint)
+        except (IOError, OSError) as exc:
+            print 'could not write sidecar', path, exc
+
+    def export(self, directory, workers=1):
+        """Write the cube and statistics as plain .npy files, spectra.npy and one per
+        metric in STATISTICS, with a JSON descriptor, cube.json, so that other tools
+        can map them with np.load(path, mmap_mode='r') rather than decoding the netCDF
+        files. The cube is built first if necessary. A sparse cube is written dense.
+        See read_export().
+
+        Keyword arguments:
+        directory - output directory, created if necessary
+        workers - no. of threads per stage used to read and decode files if the cube
+                  has to be built
+
+        Returns:
+        The path of the descriptor
+
+        """
+        self._ensure_cube()
+        arrays = {'spectra': self.cube(workers)}
+        arrays.update(self.statistics)
+        descriptor = {
+            'fingerprint': self.fingerprint(),
+            'detector_shape': list(self.shape),
+            'geometry': self.geometry.name if self.geometry is not None else None,
+            'element_index': 'row * cols + col',
+            'axes': {'spectra': ['pixel_step', 'element', 'bin'],
+                     'statistics': ['pixel_step', 'element']},
+            'statistics': STATISTICS,
+            'mca_bins': self.mca_bins,
+            'rebin': self.rebin,
+            'first_step': self.first_step,
+        }
+        return write_export(directory, arrays, descriptor)
+
+    def statistics_arrays(self, workers=1, on_decoded=None):
+        """Return the channel statistics of all pixel_steps and elements. Unless the cube
+        has been built, they are decoded on first use from the pixel headers of every
+        available file in one vectorized pass per file, without keeping any spectra.
+
+        Keyword arguments:
+        workers - no. of threads per stage used to read and decode files
+        on_decoded - optional function called with (first, end, statistics) as soon as
+                     pixel_steps [first, end) are decoded, like that of cube()
+
+        Returns:
+        A dict keyed by metric (see STATISTICS) of (steps, elements) uint32 arrays,
+        where the element index is row * cols + col.
+
+        """
+        if self.statistics is None:
+            steps = self._count_complete_steps()
+            statistics = self._allocate_statistics(steps)
+            if on_decoded is not None:
+                notify = lambda first, end: on_decoded(first, end, statistics)
+            else:
+                notify = None
+            steps = self._decode_all_files(
+                self._file_stages(statistics=statistics), 0, steps, workers,
+                on_decoded=notify)
+            self.statistics = {metric: statistics[metric][:steps] for metric in STATISTICS}
+        elif on_decoded is not None and len(self.statistics['realtime']):
+            on_decoded(0, len(self.statistics['realtime']), self.statistics)
+        return self.statistics
+
+    def _allocate_statistics(self, steps):
+        return {metric: np.zeros((steps, self.rows * self.cols), dtype=np.uint32)
+                for metric in STATISTICS}
+
+    def _build_cube(self, workers=1, on_decoded=None):
+        """Allocate the spectrum cube and statistic arrays and fill them by reading
+        every available file once.
+
+        Keyword arguments:
+        workers - no. of threads per stage used to read and decode files
+        on_decoded - optional function, see cube()
+
+        """
+        complete_steps = self._count_complete_steps()
+        while True:
+            dtype = self.spectrum_dtype
+            if self.sparse:
+                spectra = SparseSpectra(complete_steps, self.rows * self.cols, self.bins,
+                                        dtype=dtype)
+            else:
+                spectra = np.zeros((complete_steps, self.rows * self.cols, self.bins),
+                                   dtype=dtype)
+            statistics = self._allocate_statistics(complete_steps)
+            if on_decoded is not None:
+                notify = lambda first, end: on_decoded(first, end, spectra, statistics)
+            else:
+                notify = None
+            steps = self._decode_all_files(
+                self._file_stages(spectra, statistics), 0, complete_steps, workers,
+                on_decoded=notify)
+            if self.spectrum_dtype == dtype:
+                break
+            print 'rebinned counts overflow {}, decoding as {}'.format(
+                np.dtype(dtype).name, np.dtype(self.spectrum_dtype).name)
+
+        if self.sparse:
+            spectra.resize(steps)
+            self.spectra = spectra
+        else:
+            self.spectra = spectra[:steps]
+        self.statistics = {metric: statistics[metric][:steps] for metric in STATISTICS}
+
+    def _decode_all_files(self, decode_file, first_step, end_step, workers=1,
+                          report=True, on_decoded=None, queue_size=4):
+        """Call decode_file(path) for every file containing pixel_steps in the semi-open
+        range [first_step, end_step).
+        Decoding stops at the first file that can't be decoded, e.g. one that is still
+        being written.
+
+        Keyword arguments:
+        decode_file - function of a file path, or a list of functions each called with
+                      the result of the previous one, the first with the path, e.g.
+                      the read and decode stages from _file_stages(). With workers > 1
+                      each function runs on workers threads of its own, so the stages
+                      of successive files overlap (see staged_imap()), and each call
+                      must only fill the part of its arrays belonging to the file. The
+                      last function may return the pixel_step following the last one
+                      the file holds data for.
+        first_step, end_step - range of pixel_steps to decode
+        workers - no. of threads per stage used to read and decode files
+        report - if True, print a message if decoding stops early
+        on_decoded - optional function called with (first, end), on the calling thread
+                     and in pixel_step order, as soon as all files holding pixel_steps
+                     [first, end) have been decoded, e.g. to reduce them while later
+                     files are still being read
+        queue_size - max no. of files waiting between two stages when workers > 1
+
+        Returns:
+        The pixel_step following the last one decoded before any failure
+
+        """
+        stages = decode_file if isinstance(decode_file, list) else [decode_file]
+        # the items are (pixel_step, path) pairs
+        first_stage = stages[0]
+        stages = [lambda step_and_path: first_stage(step_and_path[1])] + stages[1:]
+
+        def decode(step_and_path):
+            try:
+                value = step_and_path
+                for stage in stages:
+                    value = stage(value)
+                return step_and_path, value, None
+            except Exception as exc:
+                return step_and_path, None, exc
+
+        if self.report_io:
+            io_before, load_start = self.io_counters.totals(), time.time()
+        paths = self._get_file_paths_for_pixel_steps(range(first_step, end_step))
+        if workers > 1:
+            results = staged_imap([(stage, workers) for stage in stages], paths,
+                                  queue_size)
+        else:
+            results = imap(decode, paths)
+        # results arrive in pixel_step order, so the first failure truncates the data;
+        # the pixel_steps of a file group are complete once all its files are decoded
+        group_step = group_end = None
+        try:
+            for (pixel_step, path), decoded_end, exc in results:
+                if pixel_step != group_step:
+                    self._notify_decoded(on_decoded, group_step, group_end, end_step)
+                    group_step, group_end = pixel_step, end_step
+                if exc is not None:
+                    if report:
+                        print 'netCDF data truncated', exc.message
+                    return min(pixel_step, end_step)
+                # a partly filled file ends the scan
+                file_end = self.reverse_lookup_file_paths_dict[
+                    os.path.basename(path)][-1] + 1
+                group_end = min(group_end, file_end)
+                if decoded_end is not None and decoded_end < min(file_end, end_step):
+                    end_step = decoded_end
+            self._notify_decoded(on_decoded, group_step, group_end, end_step)
+        finally:
+            close = getattr(results, 'close', None)
+            if close is not None:
+                close()
+            if self.report_io:
+                io_after = self.io_counters.totals()
+                print 'netCDF I/O:', format_io_totals(
+                    {field: io_after[field] - io_before[field] for field in io_after},
+                    time.time() - load_start)
+        return end_step
+
+    def _notify_decoded(self, on_decoded, first, end, end_step):
+        end = min(end, end_step) if end is not None else None
+        if on_decoded is not None and first is not None and end > first:
+            on_decoded(first, end)
+
+    def _read_buffer_headers(self, array_data):
+        """Return the buffer headers of the first module of each buffer in a file.
+
+        Keyword arguments:
+        array_data - the file's (buffers, modules, words) array_data variable
+
+        Returns:
+        A (buffers,) ndarray with dtype=buffer_header_mode1_dtype
+
+        """
+        headers = np.ascontiguousarray(array_data[:, 0, :256]).view(uint16)
+        return headers.view(buffer_header_mode1_dtype)[:, 0]
+
+    def _pixels_in_buffers(self, array_data):
+        """Return the no. of filled pixel blocks in each buffer of a file, as reported
+        by the buffer headers. The last buffer of a scan is normally only partly
+        filled. Buffers without a valid header are assumed to be full.
+
+        """
+        headers = self._read_buffer_headers(array_data)
+        tagged = (headers['tag0'] == BUFFER_TAGS[0]) & (headers['tag1'] == BUFFER_TAGS[1])
+        return np.where(tagged, headers['pixels_in_buffer'], self.pixelsteps_per_buffer)
+
+    def _valid_pixels(self, array_data, buffer_ixs, pixel_ixs):
+        """Return a mask of the pixel blocks that the buffer headers report as
+        filled.
+
+        """
+        return pixel_ixs < self._pixels_in_buffers(array_data)[buffer_ixs]
+
+    def _count_steps_in_file(self, path):
+        """Return the no. of leading pixel_steps a file holds, peeking at just its
+        netCDF header and buffer headers, or 0 if it can't be read.
+
+        """
+        try:
+            f = self._open_file(path, use_mmap=True)
+        except (IOError, ValueError, EnvironmentError):
+            return 0
+        try:
+            steps = 0
+            for pixels in self._pixels_in_buffers(f.variables['array_data']):
+                steps += int(pixels)
+                if pixels < self.pixelsteps_per_buffer:
+                    break
+            return steps
+        finally:
+            f.close()
+
+    def check_completeness(self):
+        """Report how much of the scan has been written, without decoding any data.
+        Each IOC's files are walked in order using the directory index and file
+        sizes: a file with the same size as an earlier full file of the IOC and a
+        successor is taken to be full, and only the others have their headers read.
+
+        Returns:
+        A dict keyed by IOC, i.e. the filename with its file no. removed (e.g.
+        'ioc53_.nc'), of the no. of complete pixel_steps of the step window written by
+        that IOC. The scan's complete steps is the minimum over the IOCs.
+
+        """
+        steps_per_file = self.pixelsteps_per_buffer * self.buffers_per_file
+        first_file_n = self.first_file_n + self.first_step // steps_per_file
+        ioc_files = defaultdict(dict)
+        for file_n, paths in self._get_all_file_groups().iteritems():
+            for path in paths:
+                ioc_files[self._get_layout_key(os.path.basename(path))][file_n] = path
+
+        completeness = {}
+        for ioc, files in ioc_files.iteritems():
+            file_n = first_file_n
+            full_size = None
+            steps = 0
+            while file_n in files:
+                size = os.path.getsize(files[file_n])
+                if size == full_size and file_n + 1 in files:
+                    file_steps = steps_per_file
+                else:
+                    file_steps = self._count_steps_in_file(files[file_n])
+                    if file_steps == steps_per_file:
+                        full_size = size
+                steps += file_steps
+                if file_steps < steps_per_file:
+                    break
+                file_n += 1
+            end = (first_file_n - self.first_file_n) * steps_per_file + steps
+            if self.end_step is not None:
+                end = min(end, self.end_step)
+            completeness[ioc] = max(0, end - self.first_step)
+        return completeness
+
+    def _detect_buffer_layout(self):
+        """Fill in pixelsteps_per_buffer and/or buffers_per_file from the first file:
+        the number of buffers is the first dimension of array_data and the number of
+        pixels per buffer is read from the first buffer header.
+
+        """
+        paths = self.file_paths_dict.get(self.first_file_n, [])
+        if not paths:
+            raise ValueError('No netCDF files found to detect the buffer layout')
+        f = self._open_file(paths[0])
+        try:
+            array_data = f.variables['array_data']
+            if self.buffers_per_file is None:
+                self.buffers_per_file = array_data.shape[0]
+            if self.pixelsteps_per_buffer is None:
+                header = self._read_buffer_headers(array_data)[0]
+                if (header['tag0'], header['tag1']) != BUFFER_TAGS:
+                    raise ValueError('Invalid buffer header in {}'.format(paths[0]))
+                self.pixelsteps_per_buffer = int(header['pixels_in_buffer'])
+        finally:
+            f.close()
+
+    def _decode_file(self, path, spectra=None, statistics=None, validity=None):
+        """Read a netCDF file and copy the spectra and/or channel statistics of all the
+        pixel_steps and elements it contains into the supplied arrays.
+
+        Keyword arguments:
+        path - netCDF file path
+        spectra - (steps, elements, bins) array to fill, or None
+        statistics - dict of (steps, elements) arrays to fill keyed by metric, or None
+        validity - (steps, elements) bool array to fill with the 'valid' result of
+                   validate_mode1_pixel_blocks(), or None
+
+        Returns:
+        The pixel_step following the last one the file holds data for
+
+        """
+        file_blocks = self._read_file_blocks(path, headers_only=spectra is None)
+        return self._decode_file_blocks(file_blocks, spectra, statistics, validity)
+
+    def _file_stages(self, spectra=None, statistics=None, validity=None):
+        """Return the stages of _decode_file() as a list of functions for
+        _decode_all_files(): reading a file's pixel blocks, then decoding them into
+        the supplied arrays.
+
+        """
+        return [lambda path: self._read_file_blocks(path, headers_only=spectra is None),
+                lambda file_blocks: self._decode_file_blocks(
+                    file_blocks, spectra, statistics, validity)]
+
+    def _read_file_blocks(self, path, headers_only=False):
+        """Read the pixel blocks of all the pixel_steps and unmasked elements a netCDF
+        file contains. This is where the file's I/O is done; the file is closed again
+        before returning.
+
+        Keyword arguments:
+        path - netCDF file path
+        headers_only - if True, read just the 256-word pixel headers
+
+        Returns:
+        A tuple (filename, pixel_steps, elements, columns, blocks):
+        pixel_steps - (steps,) pixel_steps with filled pixel blocks
+        elements - ndarray of the elements read
+        columns - position of each element in the module channels of blocks, as a
+                  slice if they are in order
+        blocks - uint16 (steps, modules, words) pixel blocks of the modules holding
+                 elements, or None if every element in the file is masked
+
+        """
+        filename = os.path.basename(path)
+        pixel_steps = np.asarray(self.reverse_lookup_file_paths_dict[filename])
+        elements = self._get_elements_to_read(filename)
+        if not len(elements):
+            return filename, pixel_steps, elements, None, None
+        # the modules holding unmasked elements and the position of each element's
+        # channel in the modules read
+        modules, positions = np.unique(self.module_ix[0, elements], return_inverse=True)
+        columns = positions * CHANNELS_PER_MODULE + self.channel[0, elements]
+        if (columns == np.arange(len(columns))).all():
+            columns = slice(0, len(elements))
+        buffer_ixs = self.buffer_ix[pixel_steps, elements[0]]
+        pixel_ixs = self.pixel_ix[pixel_steps, elements[0]]
+        block_size = 256 + 4 * self.mca_bins
+        # only the pixel header is needed for the statistics
+        words = 256 + (0 if headers_only else 4 * self.mca_bins)
+
+        # when only the headers or some of the modules are wanted, map the file so that
+        # the pages holding just other data are never read
+        use_mmap = headers_only or self._skips_modules(filename)
+        f = self._open_file(path, use_mmap=use_mmap)
+        start = time.time()
+        try:
+            array_data = f.variables['array_data']
+            valid = self._valid_pixels(array_data, buffer_ixs, pixel_ixs)
+            if not valid.all():
+                pixel_steps, buffer_ixs, pixel_ixs = \
+                    pixel_steps[valid], buffer_ixs[valid], pixel_ixs[valid]
+            # (buffers, modules, pixels, block_size) pixel blocks, skipping the buffer
+            # header
+            buffers = array_data[:, :, 256: 256 + self.pixelsteps_per_buffer * block_size]
+            buffers = buffers.reshape(buffers.shape[:2] +
+                                      (self.pixelsteps_per_buffer, block_size))
+            # (steps, modules, words)
+            if len(modules) == buffers.shape[1]:
+                blocks = buffers[buffer_ixs, :, pixel_ixs, :words]
+            else:
+                blocks = buffers[buffer_ixs[:, np.newaxis], modules,
+                                 pixel_ixs[:, np.newaxis], :words]
+            del buffers
+            # blocks gathered from a mapped file are the only data read from it
+            self.io_counters.add(filename, read_time=time.time() - start,
+                                 bytes_read=blocks.nbytes if use_mmap else 0)
+            return filename, pixel_steps, elements, columns, blocks.view(uint16)
+        finally:
+            f.close()
+
+    def _decode_file_blocks(self, file_blocks, spectra=None, statistics=None,
+                            validity=None):
+        """Decode the pixel blocks returned by _read_file_blocks() into the supplied
+        arrays. See _decode_file().
+
+        """
+        filename, pixel_steps, elements, columns, blocks = file_blocks
+        if blocks is None:
+            return int(pixel_steps[-1]) + 1     # every element in the file is masked
+        start = time.time()
+        if elements[-1] - elements[0] + 1 == len(elements):
+            where = (pixel_steps, slice(elements[0], elements[-1] + 1))
+        else:
+            where = (pixel_steps[:, np.newaxis], elements)
+        valid = None
+        if validity is not None or self.validate_blocks:
+            valid = self._check_pixel_blocks(filename, blocks, pixel_steps)
+            valid = valid[:, columns]
+            if validity is not None:
+                validity[where] = valid
+            if valid.all() or not self.validate_blocks:
+                valid = None
+        if statistics is not None:
+            values = decode_mode1_statistics(blocks[:, :, :256])
+            for metric in STATISTICS:
+                metric_values = values[metric][:, columns]
+                if valid is not None:
+                    metric_values = np.where(valid, metric_values, 0)
+                statistics[metric][where] = metric_values
+            del values
+        if spectra is not None:
+            block_spectra = self._rebin(
+                blocks[:, :, 256:].reshape(len(pixel_steps), -1, self.mca_bins)
+                [:, columns])
+            if valid is not None:
+                block_spectra = block_spectra * valid[..., np.newaxis]
+            spectra[where] = block_spectra
+            del block_spectra
+        self.io_counters.add(filename, decode_time=time.time() - start)
+        if len(pixel_steps):
+            return int(pixel_steps[-1]) + 1
+        return int(self.reverse_lookup_file_paths_dict[filename][0])
+
+    def _check_pixel_blocks(self, filename, blocks, pixel_steps):
+        """Validate the pixel blocks read from a file, printing a summary of any
+        problems found.
+
+        Keyword arguments:
+        filename - name of the file the blocks were read from, for the report
+        blocks - uint16 (steps, modules, words) pixel blocks
+        pixel_steps - (steps,) pixel_step of each row of blocks
+
+        Returns:
+        The (steps, modules * CHANNELS_PER_MODULE) 'valid' mask of
+        validate_mode1_pixel_blocks()
+
+        """
+        problems = validate_mode1_pixel_blocks(blocks, self.mca_bins, pixel_steps,
+                                               self._scan_pixel_number_offset())
+        valid = problems['valid']
+        if not valid.all():
+            # no. of blocks failing each check. Blocks that are missing altogether
+            # are counted only as bad tags.
+            tagged = ~problems['tags']
+            counts = []
+            for check in PIXEL_BLOCK_CHECKS:
+                failed = problems[check]
+                if failed.ndim == 3:
+                    failed = failed.any(axis=2)
+                if check != 'tags':
+                    failed = failed & tagged
+                counts.append((check, np.count_nonzero(failed)))
+            bad_steps = np.asarray(pixel_steps)[~valid.all(axis=1)]
+            print 'invalid pixel blocks in', filename, ', '.join(
+                '{} {}'.format(count, check) for check, count in counts if count), \
+                'at pixel_steps', bad_steps + self.first_step
+        return valid
+
+    def _scan_pixel_number_offset(self):
+        """Return the pixel_number the XMAP gave pixel_step 0, read once per scan from
+        the pixel headers of the first file group as their most common offset from
+        pixel_step, so that every file is checked against the same numbering. None if
+        no file of the group holds a pixel block.
+
+        """
+        if self._pixel_number_offset is None and len(self.file_groups):
+            for path in self.file_paths_dict.get(int(self.file_groups[0]), []):
+                _, pixel_steps, _, _, blocks = self._read_file_blocks(
+                    path, headers_only=True)
+                if blocks is not None:
+                    self._pixel_number_offset = pixel_number_offset(blocks, pixel_steps)
+                if self._pixel_number_offset is not None:
+                    break
+        return self._pixel_number_offset
+
+    def validate(self, workers=1):
+        """Check the pixel header of every pixel block of the scan without decoding any
+        data, reading just the headers of one file at a time in a vectorized pass.
+        Problems found are printed per file.
+
+        Keyword arguments:
+        workers - no. of threads used to read files
+
+        Returns:
+        A (steps, elements) bool array, True where an element's pixel block passed
+        every check of validate_mode1_pixel_blocks(). Elements excluded by
+        element_mask are False.
+
+        """
+        steps = self._count_complete_steps()
+        validity = np.zeros((steps, self.rows * self.cols), dtype=bool)
+        steps = self._decode_all_files(
+            self._file_stages(validity=validity), 0, steps, workers)
+        return validity[:steps]
+
+    def _build_cumulative_spectra(self):
+        """Build the running sum of every spectrum in the cube along the bin axis,
+        with a leading zero bin so that any semi-open bin range [low, high) sums to
+        cumulative_spectra[..., high] - cumulative_spectra[..., low].
+        The largest possible sum, mca_bins * 0xFFFF, fits in a uint32 at any rebin.
+        Called under _cube_lock with the cube loaded.
+
+        """
+        spectra = self.spectra
+        steps, elements, bins = spectra.shape
+        cumulative = np.zeros((steps, elements, bins + 1), dtype=np.uint32)
+        np.cumsum(spectra, axis=2, dtype=np.uint32, out=cumulative[:, :, 1:])
+        self.cumulative_spectra = cumulative
+
+    def roi_sums(self, roi_low, roi_high):
+        """Return the ROI sums of all spectra in the cube.
+        The cumulative spectrum cube is built on first use, after which any ROI costs
+        two gathers and a subtraction per spectrum. The last result is kept, so that
+        repeated requests for the same ROI from every pixel are free.
+
+        Keyword arguments:
+        roi_low, roi_high - semi-open range of MCA bins, as for spectrum()[low:high]
+
+        Returns:
+        An ndarray of shape (steps, elements) and dtype uint32
+
+        """
+        key, sums = self._last_roi
+        if key == (roi_low, roi_high):
+            return sums
+
+        # clip to the bin range, as slicing would
+        low = min(max(roi_low, 0), self.bins)
+        high = min(max(roi_high, low), self.bins)
+        built = False
+        while True:
+            self._ensure_cube(build=True)
+            with self._cube_lock:
+                if self.spectra is None:
+                    continue        # released by the cube budget meanwhile
+                if isinstance(self.spectra, SparseSpectra):
+                    sums = self.spectra.roi_sums(low, high)
+                else:
+                    if self.cumulative_spectra is None:
+                        self._build_cumulative_spectra()
+                        built = True
+                    cumulative = self.cumulative_spectra
+                    sums = cumulative[:, :, high] - cumulative[:, :, low]
+                self._last_roi = ((roi_low, roi_high), sums)
+                break
+        # outside _cube_lock, as the budget may release other instances' cubes
+        if built:
+            self._use_budget(resized=True)
+        return sums
+
+    def _build_summed_area_table(self):
+        """Build the summed-area table of the cube over pixel_steps and bins, where
+        entry [s, e, b] is the total counts of element e in bins [0, b) over
+        pixel_steps [0, s), so that the counts in any window of pixel_steps and bins
+        are the sum of 4 entries. It is uint32 if the total counts of every element
+        fit, otherwise uint64. Called under _cube_lock with the cube loaded.
+
+        """
+        spectra = self.spectra
+        steps, elements, bins = spectra.shape
+        if isinstance(spectra, SparseSpectra):
+            step_spectra = spectra.dense_step
+            totals = spectra.roi_sums(0, bins).sum(axis=0, dtype=np.uint64)
+        else:
+            step_spectra = spectra.__getitem__
+            totals = spectra.sum(axis=(0, 2), dtype=np.uint64)
+        dtype = np.uint32 if not steps or totals.max() <= 0xFFFFFFFF else np.uint64
+        table = np.zeros((steps + 1, elements, bins + 1), dtype=dtype)
+        for pixel_step in range(steps):
+            np.cumsum(step_spectra(pixel_step), axis=1, dtype=dtype,
+                      out=table[pixel_step + 1, :, 1:])
+            table[pixel_step + 1] += table[pixel_step]
+        self.summed_area_table = table
+
+    def window_sums(self, first_step, end_step, roi_low, roi_high, elements=None):
+        """Return the total counts in a window of pixel_steps and bins for each of a set
+        of elements, e.g. the counts in bins 600-800 over pixel_steps 100-300 of 12
+        chosen elements. The summed-area table of the cube is built on first use,
+        after which any window costs 4 lookups per element.
+
+        Keyword arguments:
+        first_step, end_step - semi-open range of pixel_steps
+        roi_low, roi_high - semi-open range of MCA bins, as for spectrum()[low:high]
+        elements - optional sequence of element indices, where the element index is
+                   row * cols + col. By default every element.
+
+        Returns:
+        A 1-D uint64 ndarray of the counts of each element
+
+        """
+        built = False
+        while True:
+            self._ensure_cube(build=True)
+            with self._cube_lock:
+                if self.spectra is None:
+                    continue        # released by the cube budget meanwhile
+                if self.summed_area_table is None:
+                    self._build_summed_area_table()
+                    built = True
+                table = self.summed_area_table
+                break
+        # outside _cube_lock, as the budget may release other instances' cubes
+        if built:
+            self._use_budget(resized=True)
+        steps, all_elements, bins = table.shape
+        # clip to the pixel_step and bin ranges, as slicing would
+        first = min(max(first_step, 0), steps - 1)
+        end = min(max(end_step, first), steps - 1)
+        low = min(max(roi_low, 0), bins - 1)
+        high = min(max(roi_high, low), bins - 1)
+        if elements is None:
+            elements = np.arange(all_elements)
+        corners = table[np.ix_([first, end], np.asarray(elements, dtype=np.intp),
+                               [low, high])].astype(np.uint64)
+        return ((corners[1, :, 1] - corners[1, :, 0]) -
+                (corners[0, :, 1] - corners[0, :, 0]))
+
     def spectrum(self, pixel_step, row, col):
         """Return the spectrum array indexed by pixel_step, row, col.
 
@@ -436,14 +2995,38 @@ class DetectorData(object):
         row, col - detector element row and column
 
         Returns:
-        An ndarray with self.mca_bins uint16-words
+        An ndarray with self.bins words of spectrum_dtype
 
         """
+        self._ensure_cube()
+        if self.spectra is not None:
+            return self.spectra[pixel_step, row * self.cols + col]
+        if self._is_masked(row, col):
+            return np.zeros(self.bins, dtype=self.spectrum_dtype)
+
         # retrieve item - we get a [buffer, channel] list
         data, channel = self.module_data_cache[(pixel_step, row, col)]
         # now extract what we're after
         item_array = data['ch{}_spectrum'.format(channel)]
-        return item_array[0]
+        return self._rebin(item_array[0])
+
+    def _is_masked(self, row, col):
+        return self.element_mask is not None and self.element_mask[row * self.cols + col]
+
+    def _rebin(self, spectra):
+        """Sum each run of rebin adjacent bins along the last axis of spectra.
+        The sums are spectrum_dtype, which stays uint16, so that rebinning shrinks
+        the cube by the rebin factor, until a sum overflows it. From then on
+        spectrum_dtype is uint32, and arrays being decoded as uint16 are decoded again.
+
+        """
+        if self.rebin == 1:
+            return spectra
+        sums = spectra.reshape(spectra.shape[:-1] + (self.bins, self.rebin)).sum(
+            axis=-1, dtype=np.uint32)
+        if self.spectrum_dtype == np.uint16 and sums.size and sums.max() > 0xFFFF:
+            self.spectrum_dtype = np.uint32
+        return sums.astype(self.spectrum_dtype, copy=False)
 
     def statistic(self, pixel_step, row, col, metric):
         """Return the fast_peaks etc. values indexed by pixel_step, row, col.
@@ -457,9 +3040,14 @@ class DetectorData(object):
         uint32 containing the metric
 
         """
+        assert metric in STATISTICS
+        if self.statistics is not None:
+            return self.statistics[metric][pixel_step, row * self.cols + col]
+        if self._is_masked(row, col):
+            return np.uint32(0)
+
         # retrieve item - we get a [buffer, channel] list
         data, channel = self.module_data_cache[(pixel_step, row, col)]
-        assert metric in ['realtime', 'livetime', 'triggers', 'output_events']
         # now extract what we're after
         item_array = self._uint32_swap_words(data['ch{}_{}'.format(channel, metric)])
         return item_array[0]